@@ -0,0 +1,207 @@
+"""Local stand-in of the wordpress REST api serving synthetic posts, media, tags and cover images"""
+
+import hashlib
+import io
+import json
+import logging
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+API_PREFIX = "/wp-json/wp/v2"
+# Max number of items in one page, same as in wordpress
+MAX_PER_PAGE = 100
+TAGS_PER_POST = 3
+
+
+def _cover_bytes(size: Tuple[int, int], quality: int = 85) -> bytes:
+    """JPEG with noise, so it's decoded and resized as slowly as a real photo"""
+
+    noise = Image.effect_noise(size, 64)
+    gradient = Image.linear_gradient("L").resize(size)
+    image = Image.merge("RGB", (noise, gradient, noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="jpeg", quality=quality)
+    return buffer.getvalue()
+
+
+class FakeWordPress:
+    """Wordpress api with generated content running in the background thread.
+    Every response is delayed by latency (seconds) to simulate remote server"""
+
+    def __init__(self, posts: int = 50, cover_size: Tuple[int, int] = (1600, 1200), latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        self.posts_count = posts
+        self.cover_size = cover_size
+        self.latency = latency
+        self.requests = 0
+        # IDs of the posts which were trashed or unpublished
+        self.unpublished = set()
+        self._requests_lock = threading.Lock()
+        self._cover = _cover_bytes(cover_size)
+        self._cover_etag = '"%s"' % hashlib.sha256(self._cover).hexdigest()[:16]
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self) -> str:
+        return self.base_url + API_PREFIX
+
+    def start(self) -> "FakeWordPress":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        LOG.info(f"Fake wordpress running on {self.base_url} ({self.posts_count} posts, covers {self.cover_size}, latency {self.latency} s)")
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeWordPress":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    # Content
+
+    def post(self, post_id: int, embed: bool) -> Dict:
+        date = datetime.today().replace(hour=12, minute=0, second=0, microsecond=0) - timedelta(minutes=post_id)
+        post = {
+            "id": post_id,
+            "date": date.isoformat(),
+            "modified": date.isoformat(),
+            "slug": f"post-{post_id}",
+            "link": f"{self.base_url}/post-{post_id}/",
+            "title": {"rendered": f"Benchmark post number {post_id} with a title long enough to be wrapped into more lines"},
+            "content": {"rendered": "<p>" + "Lorem ipsum dolor sit amet. " * 50 + "</p>"},
+            "featured_media": 1000 + post_id,
+            "tags": [post_id % 10 + i for i in range(TAGS_PER_POST)],
+        }
+        if embed:
+            post["_embedded"] = {"wp:featuredmedia": [self.media(1000 + post_id)]}
+        return post
+
+    def media(self, media_id: int) -> Dict:
+        return {"id": media_id, "link": f"{self.base_url}/covers/{media_id}.jpg"}
+
+    def tag(self, tag_id: int) -> Dict:
+        return {"id": tag_id, "name": f"tag-{tag_id}"}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive connections, same as real server behind the pooled session
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                with fake._requests_lock:
+                    fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                try:
+                    fake._route(self, url.path, query)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
+
+    def _route(self, handler: BaseHTTPRequestHandler, path: str, query: Dict[str, List[str]]) -> None:
+        if path.startswith("/covers/"):
+            return self._send_cover(handler)
+
+        if not path.startswith(API_PREFIX):
+            return self._send_json(handler, {"code": "rest_no_route"}, status=404)
+
+        parts = path[len(API_PREFIX):].strip("/").split("/")
+        collection = parts[0]
+        item_id = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+
+        if collection == "posts":
+            return self._send_posts(handler, query)
+        if collection == "media":
+            if item_id is not None:
+                return self._send_json(handler, self.media(item_id))
+            return self._send_json(handler, [self.media(x) for x in self._include(query)])
+        if collection == "tags":
+            if item_id is not None:
+                return self._send_json(handler, self.tag(item_id))
+            return self._send_json(handler, [self.tag(x) for x in self._include(query)])
+
+        return self._send_json(handler, {"code": "rest_no_route"}, status=404)
+
+    @staticmethod
+    def _include(query: Dict[str, List[str]]) -> List[int]:
+        values = ",".join(query.get("include", []))
+        return [int(x) for x in values.split(",") if x.isdigit()]
+
+    def _send_posts(self, handler: BaseHTTPRequestHandler, query: Dict[str, List[str]]) -> None:
+        embed = "_embed" in query
+        slugs = query.get("slug[]", []) + query.get("slug", [])
+        per_page = int(query.get("per_page", ["10"])[0])
+        if per_page > MAX_PER_PAGE:
+            return self._send_json(handler, {"code": "rest_invalid_param"}, status=400)
+
+        if slugs:
+            ids = [int(x.split("-")[-1]) for x in slugs if x.split("-")[-1].isdigit()]
+            posts = [self.post(x, embed) for x in ids if 0 < x <= self.posts_count and x not in self.unpublished]
+            return self._send_json(handler, posts)
+        if "include" in query:
+            ids = [x for x in self._include(query) if 0 < x <= self.posts_count and x not in self.unpublished]
+            return self._send_json(handler, [self.post(x, embed) for x in ids])
+
+        page = int(query.get("page", ["1"])[0])
+        total_pages = max(1, -(-self.posts_count // per_page))
+        if page > total_pages:
+            return self._send_json(handler, {"code": "rest_post_invalid_page_number"}, status=400)
+
+        first = (page - 1) * per_page + 1
+        ids = range(first, min(first + per_page, self.posts_count + 1))
+        headers = {"X-WP-Total": str(self.posts_count), "X-WP-TotalPages": str(total_pages)}
+        return self._send_json(handler, [self.post(x, embed) for x in ids if x not in self.unpublished], headers=headers)
+
+    def _send_json(self, handler: BaseHTTPRequestHandler, data, status: int = 200, headers: Optional[Dict] = None) -> None:
+        body = json.dumps(data).encode("utf-8")
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+        if status == 200 and handler.headers.get("If-None-Match") == etag:
+            return self._send(handler, 304, b"", {"ETag": etag})
+        headers = dict(headers or {}, ETag=etag)
+        self._send(handler, status, body, headers, content_type="application/json; charset=UTF-8")
+
+    def _send_cover(self, handler: BaseHTTPRequestHandler) -> None:
+        if handler.headers.get("If-None-Match") == self._cover_etag:
+            return self._send(handler, 304, b"", {"ETag": self._cover_etag})
+        self._send(handler, 200, self._cover, {"ETag": self._cover_etag}, content_type="image/jpeg")
+
+    @staticmethod
+    def _send(handler: BaseHTTPRequestHandler, status: int, body: bytes, headers: Dict, content_type: str = None) -> None:
+        handler.send_response(status)
+        if content_type:
+            handler.send_header("Content-Type", content_type)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
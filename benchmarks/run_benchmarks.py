@@ -0,0 +1,316 @@
+"""Benchmark of the whole stories pipeline against the local fake wordpress.
+
+Measures getting posts metadata, creating elements, creating stories, zip download and email
+for every batch size - once with empty caches (cold) and repeatedly with warm caches.
+Stories are always rendered, render cache and prerendering are disabled also for the warm runs.
+Results are written as JSON, compared with the baseline results if provided:
+
+    python -m benchmarks.run_benchmarks --batch-sizes 1,5,20 --latency 0.05 --output benchmark.json
+    python -m benchmarks.run_benchmarks --baseline benchmark.json --tolerance 0.2
+
+Exits with status 1 if any result is worse than the baseline by more than the tolerance.
+Other WPIG_* variables (e.g. WPIG_RENDER_WORKERS) are applied the same way as in the app.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import yaml
+
+from .fake_wordpress import FakeWordPress
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+PROJECT_FOLDER = Path(__file__).parent.parent
+
+SITE = "benchmark"
+OPERATIONS = ["get_posts_metadata", "get_elements", "create_stories", "download_zip", "send_email"]
+
+# Values compared with the baseline: (key, higher is better)
+COMPARED = [("p95_seconds", False), ("throughput", True), ("peak_rss_kb", False)]
+
+
+def parse_args(args: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark of the stories pipeline with the local fake wordpress.")
+    parser.add_argument("--batch-sizes", default="1,5,20", help="Comma separated numbers of stories created at once.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs with warm caches for every batch size.")
+    parser.add_argument("--posts", type=int, default=100, help="Number of posts served by the fake wordpress.")
+    parser.add_argument("--cover-size", default="1600x1200", help="Size of the cover images (WIDTHxHEIGHT).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay of every fake wordpress response (seconds).")
+    parser.add_argument("--template", default="ht", help="Site whose template is used for the stories.")
+    parser.add_argument("--output", default="benchmark.json", help="Path to the JSON file with results.")
+    parser.add_argument("--baseline", default=None, help="JSON file with results of the previous run to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline.")
+    return parser.parse_args(args)
+
+
+def prepare_environment(work_folder: Path) -> None:
+    """Keep all data of the benchmark in its own folder (must be done before the app modules are imported)"""
+
+    os.environ.setdefault("WPIG_CACHE_FOLDER", str(work_folder / "cache"))
+    os.environ.setdefault("WPIG_WORKSPACES_FOLDER", str(work_folder / "workspaces"))
+    os.environ.setdefault("WPIG_JOBS_FOLDER", str(work_folder / "jobs"))
+    os.environ["WPIG_DATA_FOLDER"] = str(work_folder / "data")
+    # Warm runs would only copy the same stories from the caches instead of rendering them
+    os.environ["WPIG_RENDER_CACHE_MAX_BYTES"] = "0"
+    os.environ["WPIG_PRERENDER_INTERVAL"] = "0"
+    os.environ.setdefault("WPIG_MAIL_ADDRESS", "benchmark@localhost")
+    # Paths in the templates of the sites
+    os.environ.setdefault("W2I_PATH", str(PROJECT_FOLDER))
+
+
+def write_template(template_site: str, api_url: str) -> None:
+    """Template of the benchmark site - template of existing site using the fake wordpress"""
+
+    with open(PROJECT_FOLDER / "data" / template_site / "template.yaml") as template_f:
+        template = yaml.safe_load(template_f)
+    template["url"] = api_url
+
+    site_folder = Path(os.environ["WPIG_DATA_FOLDER"]) / SITE
+    os.makedirs(site_folder, exist_ok=True)
+    with open(site_folder / "template.yaml", "w") as template_f:
+        yaml.safe_dump(template, template_f)
+
+
+def reset_caches() -> None:
+    """Remove downloaded images, composites, archives, rendered stories and cached api responses"""
+
+    from src.api_cache import get_api_cache
+    from src.image_cache import BACKGROUNDS
+    from src.render_state import COMPOSITES
+
+    cache = Path(os.environ["WPIG_CACHE_FOLDER"])
+    for folder in ["images", "archives", "renders", "prerendered"]:
+        shutil.rmtree(cache / folder, ignore_errors=True)
+    api_cache = get_api_cache()
+    if api_cache is not None:
+        api_cache.clear()
+    BACKGROUNDS.clear()
+    COMPOSITES.clear()
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Nearest-rank percentile"""
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def peak_rss_kb() -> int:
+    """Peak memory of this process (and of finished render processes)"""
+
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    if sys.platform == "darwin":
+        own, children = own // 1024, children // 1024
+    return max(own, children)
+
+
+class Run:
+    """Single run of all operations for one batch size"""
+
+    def __init__(self, batch_size: int):
+        from src.workspaces import new_workspace
+
+        self.batch_size = batch_size
+        self.workspace = new_workspace()
+        self.durations = {}
+        self.story_durations = []
+
+    def measure(self, operation: str, func: Callable, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.durations[operation] = time.perf_counter() - start
+        return result
+
+    def execute(self) -> "Run":
+        from src.create_stories import get_story_template, get_elements, create_stories
+        from src.create_stories import Template, PostData, ImageElements
+        from src.get_posts_metadata import get_posts_metadata
+
+        posts_from = (datetime.today() - timedelta(days=1)).strftime("%Y-%m-%d")
+        posts_data = self.measure("get_posts_metadata", get_posts_metadata, SITE, [], self.batch_size, posts_from)
+
+        template = Template.model_validate(get_story_template(SITE))
+        posts = [PostData.model_validate(x) for x in posts_data]
+        elements = self.measure("get_elements", get_elements, posts, template)
+
+        posts_elements = [ImageElements.model_validate(x) for x in elements]
+        metadata = self.measure("create_stories", create_stories, SITE, posts_elements, False, self.workspace)
+        if metadata is None:
+            raise RuntimeError("Stories creation failed.")
+        self.story_durations = [sum(x["timings"].values()) / 1000 for x in metadata if x.get("timings")]
+
+        self.measure("download_zip", download_zip, SITE, self.workspace)
+        self.measure("send_email", send_email, SITE, [x["url"] for x in metadata], self.workspace)
+        return self
+
+
+def download_zip(site: str, workspace: str) -> int:
+    """Same steps as the download endpoint, returns size of the archive"""
+
+    from src.archives import archive_key, get_cached_archive, stream_archive
+    from src.file_paths import stories_folder
+
+    folder = stories_folder(site, workspace)
+    key = archive_key(folder)
+    cached = get_cached_archive(key)
+    if cached is not None:
+        with open(cached, "rb") as archive_f:
+            return len(archive_f.read())
+    return sum(len(x) for x in stream_archive(folder, key))
+
+
+def send_email(site: str, links: List[str], workspace: str) -> None:
+    """Create the email with all stories the same way as the app, it's only not sent to the SMTP server"""
+
+    from flask_mail import email_dispatched
+    from src.app import app, _send_stories_mail
+
+    app.extensions["mail"].suppress = True
+    if not email_dispatched.receivers:
+        # Serialize message, the same work as before sending it
+        email_dispatched.connect(lambda message, app: message.as_bytes())
+
+    with app.app_context():
+        _send_stories_mail(site, links, "benchmark@localhost", workspace)
+
+
+def summarize(batch_size: int, cold: Run, warm: List[Run]) -> List[Dict]:
+    results = []
+    for operation in OPERATIONS:
+        durations = [x.durations[operation] for x in warm] or [cold.durations[operation]]
+        mean = sum(durations) / len(durations)
+        results.append({
+            "batch_size": batch_size,
+            "operation": operation,
+            "cold_seconds": round(cold.durations[operation], 4),
+            "mean_seconds": round(mean, 4),
+            "p50_seconds": round(percentile(durations, 50), 4),
+            "p95_seconds": round(percentile(durations, 95), 4),
+            "max_seconds": round(max(durations), 4),
+            # Stories per second
+            "throughput": round(batch_size / mean, 2) if mean else None,
+            "peak_rss_kb": peak_rss_kb(),
+        })
+
+    story_durations = [x for run in [cold] + warm for x in run.story_durations]
+    if story_durations:
+        results.append({
+            "batch_size": batch_size,
+            "operation": "story",
+            "p50_seconds": round(percentile(story_durations, 50), 4),
+            "p95_seconds": round(percentile(story_durations, 95), 4),
+            "max_seconds": round(max(story_durations), 4),
+        })
+    return results
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """Descriptions of the results which are worse than in the baseline"""
+
+    previous = {(x["batch_size"], x["operation"]): x for x in baseline}
+    regressions = []
+    for result in results:
+        base = previous.get((result["batch_size"], result["operation"]))
+        if base is None:
+            continue
+        for key, higher_is_better in COMPARED:
+            new, old = result.get(key), base.get(key)
+            if not new or not old:
+                continue
+            change = (old - new) / old if higher_is_better else (new - old) / old
+            if change > tolerance:
+                regressions.append(f"{result['operation']} ({result['batch_size']} stories): {key} {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=PROJECT_FOLDER, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args: List[str] = None) -> int:
+    options = parse_args(args)
+    batch_sizes = [int(x) for x in options.batch_sizes.split(",") if x]
+    cover_size = tuple(int(x) for x in options.cover_size.lower().split("x"))
+
+    output_path = Path(options.output).resolve()
+    baseline_path = Path(options.baseline).resolve() if options.baseline else None
+
+    work_folder = Path(tempfile.mkdtemp(prefix="wpig_benchmark_"))
+    prepare_environment(work_folder)
+    # App writes its log into the working directory
+    os.chdir(work_folder)
+
+    results = []
+    try:
+        with FakeWordPress(options.posts, cover_size, options.latency) as wordpress:
+            write_template(options.template, wordpress.api_url)
+            for batch_size in batch_sizes:
+                LOG.info(f"Benchmarking batch of {batch_size} stories...")
+                reset_caches()
+                cold = Run(batch_size).execute()
+                warm = [Run(batch_size).execute() for _ in range(options.repeat)]
+                results.extend(summarize(batch_size, cold, warm))
+            requests_count = wordpress.requests
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "batch_sizes": batch_sizes,
+            "repeat": options.repeat,
+            "posts": options.posts,
+            "cover_size": list(cover_size),
+            "latency": options.latency,
+            "template": options.template,
+            "env": {k: v for k, v in sorted(os.environ.items()) if k.startswith("WPIG_") and "PASSWORD" not in k},
+        },
+        "wordpress_requests": requests_count,
+        "results": results,
+    }
+
+    regressions = []
+    if baseline_path is not None:
+        with open(baseline_path) as baseline_f:
+            regressions = compare(results, json.load(baseline_f)["results"], options.tolerance)
+        report["baseline"] = str(baseline_path)
+        report["regressions"] = regressions
+
+    with open(output_path, "w") as output_f:
+        json.dump(report, output_f, indent=2)
+    LOG.info(f"Results written to '{output_path}'")
+
+    for regression in regressions:
+        LOG.error(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    LOG.setLevel(logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""Persistent cache of the wordpress api responses shared by all workers"""
+
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from contextlib import closing
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from .file_paths import cache_folder
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+CACHE_ENABLED = os.getenv("WPIG_API_CACHE", "1") == "1"
+MAX_ENTRIES = int(os.getenv("WPIG_API_CACHE_MAX_ENTRIES", "5000"))
+
+# Time in seconds for which the response is considered fresh (without revalidation)
+# Media and tags almost never change, list of posts can change any minute
+ENDPOINT_TTL = {
+    "posts": 60,
+    "media": 7 * 24 * 3600,
+    "tags": 7 * 24 * 3600,
+}
+DEFAULT_TTL = 300
+
+
+def endpoint_ttl(url: str) -> int:
+    """Get TTL by the api endpoint of the url (e.g. .../wp/v2/media/123 -> media)"""
+
+    parts = urlparse(url).path.rstrip("/").split("/")
+    for part in reversed(parts[-2:]):
+        if part in ENDPOINT_TTL:
+            return ENDPOINT_TTL[part]
+    return DEFAULT_TTL
+
+
+class CachedResponse:
+    """Response stored in the cache"""
+
+    def __init__(self, body: bytes, headers: Dict, etag: Optional[str], last_modified: Optional[str], stored_at: float):
+        self.body = body
+        self.headers = headers
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at
+
+    def is_fresh(self, ttl: int) -> bool:
+        return time.time() - self.stored_at < ttl
+
+    def conditional_headers(self) -> Dict:
+        """Headers for revalidation of the stale response"""
+
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ApiCache:
+    """SQLite store of responses with LRU eviction"""
+
+    def __init__(self, path: str, max_entries: int = MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._create_table()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _create_table(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    headers TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Get stored response and mark it as recently used"""
+
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT body, headers, etag, last_modified, stored_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+
+        body, headers, etag, last_modified, stored_at = row
+        return CachedResponse(body, json.loads(headers), etag, last_modified, stored_at)
+
+    def put(self, key: str, body: bytes, headers: Dict) -> None:
+        """Store response and evict least recently used ones over the limit"""
+
+        now = time.time()
+        lower_headers = {k.lower(): v for k, v in headers.items()}
+        etag = lower_headers.get("etag")
+        last_modified = lower_headers.get("last-modified")
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, body, json.dumps(headers), etag, last_modified, now, now),
+            )
+            conn.execute(
+                """DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            )
+
+    def refresh(self, key: str) -> None:
+        """Mark stored response as fresh after successful revalidation"""
+
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+
+    def clear(self) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM responses")
+
+
+_cache = None
+
+
+def get_api_cache() -> Optional[ApiCache]:
+    """Cache instance of the worker, None if caching is disabled or not available"""
+
+    global _cache
+
+    if not CACHE_ENABLED:
+        return None
+
+    if _cache is None:
+        try:
+            _cache = ApiCache(str(cache_folder() / "api_cache.sqlite"))
+        except (sqlite3.Error, OSError):
+            LOG.exception("Api cache couldn't be opened, responses will not be cached.")
+            return None
+    return _cache
@@ -2,20 +2,30 @@ import json
 import logging
 import os
 import secrets
-import shutil
 import sys
+import time
 from urllib.parse import unquote
 
 from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory, session, send_file
+from flask import Response, stream_with_context
 from flask_mail import Mail, Message
 from pydantic import ValidationError
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from .create_stories import create_stories, get_story_template, get_elements, adjust_elements
+from .archives import archive_key, get_cached_archive, story_files, stream_archive
+from .create_stories import create_stories, get_story_template, get_elements, adjust_elements, set_preview
 from .create_stories import Template, PostData, ImageElements
 from .delete_stories import delete_story_file, reorder_stories
-from .file_paths import project_folder
+from .encoders import MIMETYPES
+from .file_paths import project_folder, stories_folder
+from .jobs import submit_job, get_job, DONE, FAILED
 from .get_posts_metadata import get_posts_metadata, modify_posts_metadata
+from .metadata_store import load_stories_metadata, save_stories_metadata, delete_story_metadata
+from .pipeline import generate_stories, has_previews, render_full_resolution
+from .prerender import start_prerender_scheduler
+from .render_state import remove_from_manifest
+from .timings import start_request, finish_request, current_timings, metrics_exposition
+from .workspaces import new_workspace, is_valid_workspace, touch_workspace, remove_expired_workspaces
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(
@@ -24,7 +34,6 @@ app.wsgi_app = ProxyFix(
 app.secret_key = os.environ.get('FLASK_APP_SECRET', secrets.token_hex(16))
 
 script_dir = os.getcwd()
-app.config["UPLOAD_FOLDER"] = os.path.join(script_dir, "stories")
 
 logging.basicConfig(level=logging.INFO, filename=os.path.join(script_dir, "app.log"), filemode="w", format='%(name)s - %(asctime)s - %(levelname)s - %(message)s')
 LOG = logging.getLogger(__name__)
@@ -59,6 +68,39 @@ app.config['MAIL_USE_SSL'] = True
      
 mail = Mail(app)
 
+# Seconds between checks of the job the request waits for
+JOB_POLL_INTERVAL = 0.2
+
+# Stories of the new posts are rendered in advance if enabled (WPIG_PRERENDER_INTERVAL)
+start_prerender_scheduler()
+
+@app.before_request
+def _start_timings():
+    start_request()
+
+
+@app.after_request
+def _server_timing(response):
+    """Add durations of the pipeline stages to the response (headers of streamed response are already sent)"""
+    
+    timings = current_timings()
+    if timings is not None and not response.is_streamed:
+        response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
+
+@app.teardown_request
+def _finish_timings(error=None):
+    finish_request(request.endpoint or "unknown")
+
+
+@app.route("/metrics")
+def metrics():
+    """Durations of the pipeline stages and requests of this worker in the Prometheus text format"""
+    
+    return Response(metrics_exposition(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/")
 def index():
     """Main page"""
@@ -66,19 +108,14 @@ def index():
     return render_template("index.html")
 
 
-@app.route("/get_posts_data", methods=["GET"])
-def get_posts_data():
-    """
-    Requests data about posts on selected wordpress site.
-    Includes data about predefined posts if any.
-    """
+def _get_posts_args() -> tuple:
+    """Get site, predefined links, number of posts and date from the request arguments"""
     
     site = request.args.get("site")
     if site is None:
-        LOG.error("Missing 'site' in the request.")
-        return jsonify({"success": False, "error": "Missing 'site' in the request."}), 400
+        raise ValueError("Missing 'site' in the request.")
         
-    links = list(filter(None, request.args.getlist("links")[0].split(",")))
+    links = list(filter(None, request.args.get("links", "").split(",")))
     if links:
         LOG.info(f"Predefined posts links found: {links}.\nStories will be created also for these posts.")
     else:
@@ -89,15 +126,53 @@ def get_posts_data():
     if not posts_number_value and links:
         posts_number = len(links)
     else:
-        try:
-            posts_number = int(posts_number_value)
-        except ValueError as ve:
-            return jsonify({"success": False, "error": str(ve)}), 400
+        posts_number = int(posts_number_value)
     
     posts_from = request.args.get("from_date")
     if posts_from is None:
-        LOG.error("Missing 'from_date' in the request.")
-        return jsonify({"success": False, "error": "Missing 'from_date' in the request."}), 400
+        raise ValueError("Missing 'from_date' in the request.")
+    
+    return site, links, posts_number, posts_from
+
+
+def _workspace() -> str:
+    """Workspace of the current session (folder with its stories), created on the first use"""
+    
+    workspace = session.get("workspace")
+    if not is_valid_workspace(workspace):
+        workspace = new_workspace()
+        session["workspace"] = workspace
+        LOG.info(f"New workspace created: '{workspace}'")
+    
+    touch_workspace(workspace)
+    remove_expired_workspaces()
+    return workspace
+
+
+def _get_stories_metadata(site: str) -> list:
+    """Metadata of created stories, session refers to them only by its workspace"""
+    
+    return load_stories_metadata(site, _workspace())
+
+
+def _sse(event: str, data: dict) -> str:
+    """Format server-sent event"""
+    
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/get_posts_data", methods=["GET"])
+def get_posts_data():
+    """
+    Requests data about posts on selected wordpress site.
+    Includes data about predefined posts if any.
+    """
+    
+    try:
+        site, links, posts_number, posts_from = _get_posts_args()
+    except ValueError as ve:
+        LOG.error(str(ve))
+        return jsonify({"success": False, "error": str(ve)}), 400
     
     try:
         posts_data = get_posts_metadata(site, links, int(posts_number), posts_from)
@@ -177,6 +252,10 @@ def create_images():
         data = request.get_json()
         site = data["site"]
         posts_elements_json = data["posts_elements"]
+        # Recreate renders again only stories which were changed
+        incremental = bool(data.get("incremental", False))
+        # Editor works with low resolution previews, full resolution is rendered on download or email
+        preview = bool(data.get("preview", False))
     except KeyError as e:
         LOG.error(f'Missing key in request: {str(e)}')
         return jsonify({"success": False, "error": f"Missing key in request {str(e)}"}), 400    
@@ -185,15 +264,17 @@ def create_images():
     try:
         # Create list of ImageElements object from json retrieved from request
         posts_elements = [ImageElements.model_validate(x) for x in posts_elements_json]
+        set_preview(posts_elements, preview)
         
         # Create images and store their metadata
-        stories_metadata  = create_stories(site, posts_elements)
+        workspace = _workspace()
+        stories_metadata  = create_stories(site, posts_elements, incremental, workspace)
         if stories_metadata is None:
             LOG.error("Stories creation failed.")
             return jsonify({"success": False, "error": f"Stories creation failed."}), 500
         
-        # Store metadata into session so they can be later reused by another endpoint
-        session["stories_metadata"] = stories_metadata
+        # Store metadata on the server so they can be later reused by another endpoint
+        save_stories_metadata(site, stories_metadata, workspace)
         
         # Show created images with metadata
         return jsonify({"success": True, "redirect_url": url_for("show_images", site=site)})
@@ -207,6 +288,40 @@ def create_images():
         return jsonify({"success": False, "error": "An unexpected error occurred."}), 500
 
 
+@app.route("/generate_stories", methods=["GET"])
+def generate_stories_stream():
+    """
+    Get posts data, create elements and images in one request.
+    Progress and every created story are streamed to the client as server-sent events.
+    """
+    
+    try:
+        site, links, posts_number, posts_from = _get_posts_args()
+    except ValueError as ve:
+        LOG.error(str(ve))
+        return jsonify({"success": False, "error": str(ve)}), 400
+    
+    preview = request.args.get("preview") == "1"
+    
+    # Session can't be changed once the response is streamed, it must refer to the workspace already
+    workspace = _workspace()
+    
+    def events():
+        for event in generate_stories(site, links, posts_number, posts_from, workspace, preview):
+            name = event.pop("event")
+            if name == "story":
+                event["image_url"] = url_for("uploaded_file", site=site, filename=event["story"]["filename"])
+            elif name == "done":
+                event["redirect_url"] = url_for("show_images", site=site)
+            yield _sse(name, event)
+    
+    return Response(
+        stream_with_context(events()), 
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+
 @app.route("/show_images", methods=["GET", "POST"])
 def show_images():
     """Display generated images along with neccessary data"""
@@ -217,7 +332,7 @@ def show_images():
         return jsonify({"success": False, "error": "Missing 'site' in the request."}), 400 
     
     metadata_key = "stories_metadata"
-    metadata = session.get(metadata_key, {})
+    metadata = _get_stories_metadata(site)
     if not metadata:
         LOG.warning(f"Key '{metadata_key}' not found in the session.")
         return render_template("stories.html", stories=metadata, site=site, empty_metadata=True)
@@ -230,7 +345,7 @@ def show_images():
 def uploaded_file(site, filename):
     """Retrieves image file"""
     
-    upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], site)
+    upload_folder = stories_folder(site, _workspace())
     return send_from_directory(upload_folder, filename)
 
 
@@ -326,31 +441,40 @@ def download_stories():
         return jsonify({"success": False, "error": "Missing 'site' in the request."}), 400 
     
     # get path to the zip archive
-    stories_path = project_folder() / "stories" / site
+    workspace = _workspace()
+    stories_path = stories_folder(site, workspace)
     if not stories_path.exists():
         LOG.error(f"Stories folder '{str(stories_path)}' does not exist")
         return jsonify({"success": False, "error": f"Stories folder '{str(stories_path)}' does not exist"}), 400 
     
-    zip_filename = "%s_stories.zip" % site
-    zip_stories_path = stories_path.parent / zip_filename
-    
-    # create zip archive
+    # Previews from the editor are replaced by the full resolution stories
+    # (frontend renders them by the job before, so the download doesn't wait)
     try:
-        shutil.make_archive(os.path.splitext(zip_stories_path)[0], "zip", stories_path)
-    except (PermissionError, shutil.Error) as e:
-        LOG.exception(f"Cannot create zip archive {zip_stories_path}")
-        return jsonify({"success": False, "error": f"Cannot create zip archive {zip_stories_path}"}), 400 
+        _render_full_resolution_by_job(site, workspace)
+    except RuntimeError as e:
+        LOG.error(str(e))
+        return jsonify({"success": False, "error": str(e)}), 500
+    
+    zip_filename = "%s_stories.zip" % site
     
     try:
-        return send_file(zip_stories_path, as_attachment=True, download_name=zip_filename)
-    except Exception as e:
-        LOG.exception("Error while sending files")
-    finally:
-        LOG.info("Folder with stories and links has been downloaded successfully...")
-        try:
-            os.remove(zip_stories_path)
-        except PermissionError as e:
-            LOG.exception(f"Error while removing zip archive: '{zip_stories_path}'")
+        key = archive_key(stories_path)
+    except OSError as e:
+        LOG.exception(f"Cannot read stories in '{stories_path}'")
+        return jsonify({"success": False, "error": "Cannot create zip archive of the stories"}), 400 
+    
+    # Archive of the same stories was already created
+    cached_archive = get_cached_archive(key)
+    if cached_archive is not None:
+        return send_file(cached_archive, as_attachment=True, download_name=zip_filename, mimetype="application/zip")
+    
+    # Archive is created while it's sent, nothing is written to the stories folder
+    LOG.info("Streaming folder with stories and links...")
+    return Response(
+        stream_archive(stories_path, key),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{zip_filename}"'},
+        )
             
     
 @app.route("/send_by_email", methods=["POST"])
@@ -376,35 +500,171 @@ def send_by_email():
     
     LOG.info(f"Recipient: '{recipient_mail}'")
     
-    # Generate email with subject, body and attachments 
     try:    
-        msg = Message(f"Storkoprístroj 3000", sender=get_mail_credentials()["mail_addr"], recipients=[recipient_mail])
-        msg.html = render_template("stories_email.html", site=site, links=links)
-        
-        stories_path = project_folder() / "stories" / site
-        
-        if not stories_path.exists():
-            LOG.error(f"Stories folder does not exists: '{str(stories_path)}'")
-            return jsonify({"success": False, "error": f"Stories folder does not exists: '{str(stories_path)}'"})
-        
-        # Attach png files from stories dir to the email          
-        png_files = stories_path.glob("*.png")
-        
-        if not png_files:
-            LOG.error(f"No PNG file in the stories folder: '{str(stories_path)}'")
-            return jsonify({"success": False, "error": f"No PNG file in the stories folder: '{str(stories_path)}'"})
-        
-        for story_file in png_files:
-            with app.open_resource(stories_path / story_file) as png_f:
-                msg.attach(str(story_file), "application/png", png_f.read())
-        
-        mail.send(message=msg)
+        _render_full_resolution_by_job(site, _workspace())
+        _send_stories_mail(site, links, recipient_mail, _workspace())
         return jsonify({"success": True})
+    except FileNotFoundError as e:
+        LOG.error(str(e))
+        return jsonify({"success": False, "error": str(e)})
     except Exception as e:
         print(f"Error sending email: {str(e)}")
         return jsonify({"success": False, "error": f"Error sending email: {str(e)}"})
     finally:
         LOG.info("Email sent successfully")
+
+
+def _send_stories_mail(site: str, links: list, recipient_mail: str, workspace: str = None) -> None:
+    """Generate email with subject, body and attachments and send it.
+    Raises FileNotFoundError if there are no stories to be sent"""
+    
+    msg = Message(f"Storkoprístroj 3000", sender=get_mail_credentials()["mail_addr"], recipients=[recipient_mail])
+    msg.html = render_template("stories_email.html", site=site, links=links)
+    
+    stories_path = stories_folder(site, workspace)
+    
+    if not stories_path.exists():
+        raise FileNotFoundError(f"Stories folder does not exists: '{str(stories_path)}'")
+    
+    # Previews from the editor are replaced by the full resolution stories
+    render_full_resolution(site, workspace)
+    
+    # Attach images of the stories, unfinished writes and other files in the stories dir are skipped
+    image_files = story_files(stories_path)
+    
+    if not image_files:
+        raise FileNotFoundError(f"No image file in the stories folder: '{str(stories_path)}'")
+    
+    for story_file in image_files:
+        with app.open_resource(stories_path / story_file) as image_f:
+            msg.attach(str(story_file), MIMETYPES[story_file.suffix], image_f.read())
+    
+    mail.send(message=msg)
+
+
+def _render_full_resolution_by_job(site: str, workspace: str = None) -> None:
+    """Render previews in the full resolution by the background job and wait for it,
+    so the worker keeps serving other requests while the stories are rendered.
+    Raises RuntimeError if rendering failed"""
+    
+    if not has_previews(site, workspace):
+        return None
+    
+    job_id = submit_job("render_full_resolution", render_full_resolution, site, workspace, site=site)
+    while True:
+        job = get_job(job_id)
+        if job is None or job["status"] == FAILED:
+            raise RuntimeError(job["error"] if job else "Stories couldn't be rendered in the full resolution.")
+        if job["status"] == DONE:
+            return None
+        time.sleep(JOB_POLL_INTERVAL)
+
+
+def _in_app_context(func, *args):
+    """Run function of the background job with access to the app (templates, mail)"""
+    
+    with app.app_context():
+        return func(*args)
+
+
+def _create_stories_job(site: str, posts_elements: list, incremental: bool, workspace: str) -> list:
+    stories_metadata = create_stories(site, posts_elements, incremental, workspace)
+    if stories_metadata is None:
+        raise RuntimeError("Stories creation failed.")
+    save_stories_metadata(site, stories_metadata, workspace)
+    return stories_metadata
+
+
+@app.route("/jobs/create_images", methods=["POST"])
+def submit_create_images():
+    """Create images in the background, returns ID of the job immediately"""
+    
+    try:
+        data = request.get_json()
+        site = data["site"]
+        posts_elements = [ImageElements.model_validate(x) for x in data["posts_elements"]]
+        incremental = bool(data.get("incremental", False))
+        set_preview(posts_elements, bool(data.get("preview", False)))
+    except KeyError as e:
+        LOG.error(f'Missing key in request: {str(e)}')
+        return jsonify({"success": False, "error": f"Missing key in request {str(e)}"}), 400
+    except ValidationError as ve:
+        LOG.error(f'ImageElements object cannot be validated: {str(ve)}')
+        return jsonify({"success": False, "error": f"ImageElements object cannot be validated: {str(ve)}"}), 400
+    
+    job_id = submit_job("create_images", _create_stories_job, site, posts_elements, incremental, _workspace(), site=site)
+    return jsonify({"success": True, "job_id": job_id, "status_url": url_for("job_status", job_id=job_id)}), 202
+
+
+@app.route("/jobs/send_by_email", methods=["POST"])
+def submit_send_by_email():
+    """Send stories by email in the background, returns ID of the job immediately"""
+    
+    data = request.get_json()
+    if data is None:
+        LOG.error("Missing body in the request.")
+        return jsonify({"success": False, "error": "Missing body in the request."}), 400 
+    
+    try:
+        site = data["site"]
+        links = [unquote(x) for x in data["links"]]
+        recipient_mail = data["mail"]
+    except KeyError as e:
+        LOG.exception("Missing key in request")
+        return jsonify({"success": False, "error": "Missing key in request"}), 400 
+    
+    job_id = submit_job("send_by_email", _in_app_context, _send_stories_mail, site, links, recipient_mail, _workspace(), site=site)
+    return jsonify({"success": True, "job_id": job_id, "status_url": url_for("job_status", job_id=job_id)}), 202
+
+
+@app.route("/jobs/render_full_resolution", methods=["POST"])
+def submit_render_full_resolution():
+    """Render previews in the full resolution in the background (before download), returns ID of the job immediately"""
+    
+    data = request.get_json()
+    if data is None or "site" not in data:
+        LOG.error("Missing 'site' in the request.")
+        return jsonify({"success": False, "error": "Missing 'site' in the request."}), 400 
+    
+    job_id = submit_job("render_full_resolution", render_full_resolution, data["site"], _workspace(), site=data["site"])
+    return jsonify({"success": True, "job_id": job_id, "status_url": url_for("job_status", job_id=job_id)}), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id: str):
+    """Current state of the background job"""
+    
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": f"Job '{job_id}' not found."}), 404
+    
+    return jsonify({
+        "success": True, 
+        "status": job["status"], 
+        "error": job["error"],
+        "result_url": url_for("job_result", job_id=job_id),
+        })
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id: str):
+    """Result of the finished background job"""
+    
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": f"Job '{job_id}' not found."}), 404
+    
+    if job["status"] == FAILED:
+        return jsonify({"success": False, "error": job["error"]}), 500
+    
+    if job["status"] != DONE:
+        return jsonify({"success": False, "status": job["status"], "error": "Job is not finished yet."}), 202
+    
+    if job["kind"] == "create_images":
+        # Created stories are shown the same way as after synchronous creation
+        return jsonify({"success": True, "data": job["result"], "redirect_url": url_for("show_images", site=job["site"])})
+    
+    return jsonify({"success": True, "data": job["result"]})
         
         
 @app.route("/delete_story/<site>/<story_number>", methods=["DELETE"])
@@ -413,21 +673,25 @@ def delete_story(site: str, story_number: str):
     
     story_number = int(story_number)
     
-    metadata_key = "stories_metadata"
-    metadata = session.get(metadata_key, {})
-    
-    # Delete png file
-    if delete_story_file(metadata[story_number], site):
-        LOG.info(f"File {story_number}.png was deleted.")
-        # Delete entry in the metadata
-        metadata.pop(story_number)
-        # Reorder png files numbers and numbers in metadata
-        metadata = reorder_stories(metadata, site)
-        session[metadata_key] = metadata
+    metadata = _get_stories_metadata(site)
+    if story_number >= len(metadata):
+        LOG.error(f"Story {story_number} does not exist.")
+        return jsonify({"success": False, "error": f"Story {story_number} does not exist"}), 404
+    
+    workspace = _workspace()
+    
+    # Delete image file
+    if delete_story_file(metadata[story_number], site, workspace):
+        LOG.info(f"Story {story_number} was deleted.")
+        # Delete entry in the metadata, numbers of the following stories are shifted in the store
+        delete_story_metadata(site, story_number, workspace)
+        remove_from_manifest(site, story_number, workspace)
+        # Reorder image files numbers
+        reorder_stories(site, workspace)
         return jsonify({"success": True})
     else:
-        LOG.error(f"File {story_number}.png was not deleted.")
-        return jsonify({"success": False, "error": f"File {story_number}.png was not deleted"})
+        LOG.error(f"Story {story_number} was not deleted.")
+        return jsonify({"success": False, "error": f"Story {story_number} was not deleted"})
     
 
 if __name__ == "__main__":
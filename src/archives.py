@@ -0,0 +1,170 @@
+"""Zip archives of the stories streamed directly to the response and cached by their content"""
+
+import hashlib
+import io
+import logging
+import os
+import sys
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from .encoders import MIMETYPES
+from .file_paths import cache_folder
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Max size of all archives stored on disk
+MAX_ARCHIVES_BYTES = int(os.getenv("WPIG_ARCHIVES_MAX_BYTES", str(200 * 1024 * 1024)))
+
+CHUNK_SIZE = 256 * 1024
+
+# Files of the stories folder which are part of the archive (besides images)
+ARCHIVED_FILES = ["links.txt"]
+
+
+def archives_folder() -> Path:
+    return cache_folder() / "archives"
+
+
+def _is_visible_file(path: Path) -> bool:
+    # Temporary files of unfinished writes start with dot
+    return path.is_file() and not path.name.startswith(".")
+
+
+def story_files(folder: Path) -> List[Path]:
+    """Images of the stories (named by their number) ordered by number"""
+
+    files = [x for x in folder.iterdir() if _is_visible_file(x) and x.suffix in MIMETYPES and x.stem.isdigit()]
+    return sorted(files, key=lambda x: int(x.stem))
+
+
+def archive_files(folder: Path) -> List[Path]:
+    """Images and links of the stories, internal files (manifest, metadata) are not archived"""
+
+    files = [x for x in folder.iterdir() if _is_visible_file(x) and (x.suffix in MIMETYPES or x.name in ARCHIVED_FILES)]
+    return sorted(files, key=lambda x: x.name)
+
+
+def _file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file_f:
+        for chunk in iter(lambda: file_f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def archive_key(folder: Path) -> str:
+    """Hash of names and contents of all archived files"""
+
+    digest = hashlib.sha256()
+    for path in archive_files(folder):
+        digest.update(f"{path.name}\0{_file_hash(path)}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_cached_archive(key: str) -> Optional[Path]:
+    """Path to the already created archive with the same content"""
+
+    path = archives_folder() / f"{key}.zip"
+    if not path.exists():
+        return None
+
+    LOG.info(f"Using cached archive '{path.name}'")
+    # Access time is used for eviction
+    os.utime(path)
+    return path
+
+
+class _StreamWriter(io.RawIOBase):
+    """Unseekable file collecting written bytes, so they can be sent as soon as zipfile writes them.
+    Everything is written also to the file of the archive cache"""
+
+    def __init__(self, cache_f=None):
+        self._chunks = []
+        self._cache_f = cache_f
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        if self._cache_f is not None:
+            self._cache_f.write(data)
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_archive(folder: Path, key: str) -> Iterator[bytes]:
+    """Create zip archive of the stories chunk by chunk.
+    Images are already compressed, so they are only stored. Finished archive is cached by its key"""
+
+    archives = archives_folder()
+    os.makedirs(archives, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=archives, prefix=".tmp_", suffix=".zip")
+    cache_f = os.fdopen(fd, "wb")
+    writer = _StreamWriter(cache_f)
+    # Files can be changed while they are streamed, archive is cached only if it matches the key
+    digest = hashlib.sha256()
+
+    try:
+        with zipfile.ZipFile(writer, "w") as archive:
+            for path in archive_files(folder):
+                info = zipfile.ZipInfo.from_file(path, path.name)
+                info.compress_type = zipfile.ZIP_STORED if path.suffix in MIMETYPES else zipfile.ZIP_DEFLATED
+                file_digest = hashlib.sha256()
+                with open(path, "rb") as file_f, archive.open(info, "w") as entry:
+                    for chunk in iter(lambda: file_f.read(CHUNK_SIZE), b""):
+                        file_digest.update(chunk)
+                        entry.write(chunk)
+                        yield writer.take()
+                digest.update(f"{path.name}\0{file_digest.hexdigest()}\n".encode("utf-8"))
+        yield writer.take()
+        cache_f.close()
+    except BaseException:
+        # Client disconnected or archive couldn't be created
+        cache_f.close()
+        os.remove(tmp_path)
+        raise
+
+    if digest.hexdigest() != key:
+        LOG.warning("Stories were changed while they were archived, archive is not cached.")
+        os.remove(tmp_path)
+        return
+
+    os.replace(tmp_path, archives / f"{key}.zip")
+    _evict_archives()
+
+
+def _evict_archives() -> None:
+    """Remove least recently used archives until they fit into the size limit"""
+
+    files = []
+    for path in archives_folder().glob("*.zip"):
+        # Archives which are being created
+        if path.name.startswith("."):
+            continue
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(x[1] for x in files)
+    for _, size, path in sorted(files):
+        if total_size <= MAX_ARCHIVES_BYTES:
+            break
+        LOG.info(f"Evicting cached archive '{path.name}'")
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
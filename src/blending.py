@@ -0,0 +1,77 @@
+"""Alpha blending of the static overlays of the template with precomputed masks"""
+
+import logging
+import sys
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Overlay is split into square tiles of this size (pixels) by its transparency
+TILE_SIZE = 64
+
+TRANSPARENT, TRANSLUCENT, OPAQUE = 0, 1, 2
+
+
+def _classify_tiles(alpha: np.ndarray, tile: int) -> np.ndarray:
+    """Transparency of every tile of the alpha mask (rows x columns of tiles)"""
+
+    height, width = alpha.shape
+    rows, columns = -(-height // tile), -(-width // tile)
+
+    def tiles(padding: int) -> np.ndarray:
+        # Tiles on the edges are padded to the full size
+        padded = np.full((rows * tile, columns * tile), padding, dtype=np.uint8)
+        padded[:height, :width] = alpha
+        return padded.reshape(rows, tile, columns, tile)
+
+    classes = np.full((rows, columns), TRANSLUCENT, dtype=np.uint8)
+    classes[~tiles(0).any(axis=(1, 3))] = TRANSPARENT
+    classes[(tiles(255) == 255).all(axis=(1, 3))] = OPAQUE
+    return classes
+
+
+class PreparedOverlay:
+    """Overlay image split once into regions by transparency, shared by all stories of the batch.
+    Transparent regions are skipped, opaque ones copied and only translucent ones alpha blended.
+    Result is the same as of Image.paste(image, position, image)"""
+
+    def __init__(self, image: Image.Image, tile: int = TILE_SIZE):
+        self.image = image
+        # (offset in overlay, cropped region, is blended)
+        self.regions: List[Tuple[Tuple[int, int], Image.Image, bool]] = []
+
+        alpha = np.asarray(image.getchannel("A"))
+        classes = _classify_tiles(alpha, tile)
+        for row, row_classes in enumerate(classes):
+            # Adjacent tiles of the same transparency are merged into one region
+            start = 0
+            for column in range(1, len(row_classes) + 1):
+                if column < len(row_classes) and row_classes[column] == row_classes[start]:
+                    continue
+                if row_classes[start] != TRANSPARENT:
+                    box = (start * tile, row * tile, min(column * tile, image.width), min((row + 1) * tile, image.height))
+                    self.regions.append(((box[0], box[1]), image.crop(box), row_classes[start] == TRANSLUCENT))
+                start = column
+
+        blended = sum(1 for x in self.regions if x[2])
+        LOG.info(f"Overlay {image.size} prepared: {len(self.regions)} regions, {blended} of them blended.")
+
+    def blend(self, canvas: Image.Image, position: Tuple[int, int]) -> None:
+        """Blend overlay into the canvas (RGBA) in place"""
+
+        x, y = position
+        for (left, top), region, is_blended in self.regions:
+            canvas.paste(region, (x + left, y + top), region if is_blended else None)
+
+
+def prepare_overlay(image: Image.Image) -> Optional[PreparedOverlay]:
+    """Prepared overlay, None if image can't be blended this way (it has no alpha channel)"""
+
+    if image.mode != "RGBA":
+        return None
+    return PreparedOverlay(image)
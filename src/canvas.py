@@ -2,15 +2,26 @@
 
 import logging
 import os
-import requests
 import sys
+import tempfile
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Literal, Optional, Tuple
 
 from PIL import Image, ImageDraw, ImageFont
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 
-Image.MAX_IMAGE_PIXELS = None
+from .encoders import encode_image, story_filename
+from .file_paths import stories_folder
+from .image_cache import BACKGROUNDS, get_cached_image
+from .render_state import base_key, store_composite
+from .text_layout import fit_text, wrap_text
+from .timings import timed
+
+# Images over these limits are not decoded at all, so a huge image can't take all the memory
+MAX_IMAGE_PIXELS = int(os.getenv("WPIG_MAX_IMAGE_PIXELS", str(60_000_000)))
+MAX_IMAGE_BYTES = int(os.getenv("WPIG_MAX_IMAGE_BYTES", str(40 * 1024 * 1024)))
+
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
 
 SCRIPT_FOLDER = Path(__file__).parent
 PROJECT_FOLDER = SCRIPT_FOLDER.parent
@@ -31,7 +42,12 @@ class Text(BaseModel):
     y_axis: int
     x_axis: int | str
     line_height: Optional[float]
-    word_wrap: Optional[int]
+    word_wrap: Optional[int] = None
+    # Wrap by width of the text in pixels instead of number of letters
+    max_width: Optional[int] = None
+    # Decrease font size (down to min_font_size) until the text fits into max_width x max_height
+    max_height: Optional[int] = None
+    min_font_size: Optional[int] = None
     anchor: str
     
     
@@ -46,6 +62,26 @@ class Background(BaseModel):
     from_cover: bool
     
 
+class Output(BaseModel):
+    """Format and compression of the created image file"""
+    
+    format: Literal["png", "jpeg", "webp"] = "png"
+    quality: int = Field(default=90, ge=1, le=100)
+    optimize: bool = False
+    colors: Optional[int] = None
+    max_bytes: Optional[int] = None
+    
+    @field_validator("format", mode="before")
+    @classmethod
+    def normalize_format(cls, value):
+        """Format is accepted in any case, 'jpg' as 'jpeg'"""
+        
+        if isinstance(value, str):
+            value = value.lower()
+            return "jpeg" if value == "jpg" else value
+        return value
+
+
 class Canvas(BaseModel):
     """Canvas width and height"""
     
@@ -63,6 +99,11 @@ class ImageElements(BaseModel):
     shapes: Optional[List]
     texts: List[Text]
     post_url: str
+    # ID of the post in wordpress, identifies stories rendered in advance
+    post_id: Optional[int] = None
+    output: Optional[Output] = None
+    # Fraction of the canvas size the story is rendered in (preview), None renders full resolution
+    preview_scale: Optional[float] = None
 
 
 def create_canvas(canvas: Canvas) -> Image:
@@ -77,53 +118,80 @@ def create_canvas(canvas: Canvas) -> Image:
     return blank_canvas
     
 
-def _merge_elements(image: Image, element: Image, position: List[str|int]) -> None:
-    """Merge together two Image objects"""
+def _merge_elements(image: Image, element: Image, position: List[str|int], prepared=None) -> None:
+    """Merge together two Image objects.
+    Element prepared for blending (static overlay from the render plan) is blended only in the area it covers"""
     
     # x_axis can be defined either in pixels or as "center"
+    # (position of the template element is not changed, so elements stay the same after rendering)
+    position = list(position)
     if position[0] == "center":
         position[0] = horizontal_center(image, element)
-    image.paste(element, tuple(position), element)
+    if prepared is not None and prepared.image is element and image.mode == "RGBA":
+        prepared.blend(image, tuple(position))
+    else:
+        image.paste(element, tuple(position), element)
     
     
-def _merge_shapes(elements: ImageElements, canvas: Image) -> None:
+def _merge_shapes(elements: ImageElements, canvas: Image, plan=None) -> None:
     """Draw shape and merge it to the canvas"""
     
     if not elements.shapes:
         return None
     
     for element in elements.shapes:
-        shape = draw_shape(element)
+        # Use already drawn shape from the render plan if available
+        shape = plan.shape(element) if plan else draw_shape(element)
         LOG.info(f"Merging shape '{element}' into canvas...")
         _merge_elements(canvas, shape, element["position"])
 
 
-def _merge_images(elements: ImageElements, canvas: Image) -> None:
+def _merge_images(elements: ImageElements, canvas: Image, plan=None) -> None:
     """Create image object out of image file and merge it to the canvas"""
     
     if not elements.images:
         return None
     
     for element in elements.images:
-        image = open_image(element["path"])
+        # Static images of the template are already loaded, resized and prepared for blending in the render plan
+        prepared = None
+        if plan and not element["from_cover"]:
+            image = plan.overlay(element["path"], element.get("size"))
+            prepared = plan.prepared_overlay(element["path"], element.get("size"))
+        else:
+            image = open_image(element["path"])
         LOG.info(f"Merging image {element} into canvas...")
         
-        # resize image if different dimensions are specified in the template
-        if "size" in element.keys() and image.size != element["size"]:
-            LOG.info(f"Resizing image: {image.size} -> {element['size']}")
-            image = image.resize(tuple(element["size"]))
-        _merge_elements(canvas, image, element["position"])
+        with timed("images"):
+            # resize image if different dimensions are specified in the template
+            if "size" in element.keys() and image.size != tuple(element["size"]):
+                LOG.info(f"Resizing image: {image.size} -> {element['size']}")
+                image = image.resize(tuple(element["size"]))
+            elif "size" not in element.keys() and elements.preview_scale:
+                # Image without size in template is scaled only when rendered
+                size = (max(1, round(image.width * elements.preview_scale)), max(1, round(image.height * elements.preview_scale)))
+                image = image.resize(size)
+            _merge_elements(canvas, image, element["position"], prepared)
     
 
-def merge_elements(elements: ImageElements, canvas: Image) -> Image:
-    """Create and put together all elements of the image"""
+def merge_elements(elements: ImageElements, canvas: Image, plan=None) -> Image:
+    """Create and put together all elements of the image.
+    Static resources are taken from the render plan of the template if provided"""
+    
+    if merge_base(elements, canvas, plan) is None:
+        return None
+    merge_texts(elements, canvas, plan)
+    
+    return canvas
+
+
+def merge_base(elements: ImageElements, canvas: Image, plan=None) -> Image:
+    """Put together all elements of the image except texts"""
     
     # Create image object of background, resize if needed and set position
     LOG.info("Getting background image...")
-    background = open_image(elements.background.path)
-    if background:
-        background = resize_background(background, elements.background.size)
-    else:
+    background = load_background(elements.background.path, elements.background.size)
+    if background is None:
         LOG.error("Loading background image failed.")
         return None
     
@@ -136,38 +204,120 @@ def merge_elements(elements: ImageElements, canvas: Image) -> Image:
     x_axis = int(elements.background.position[0])
     y_axis = int(elements.background.position[1])
     
-    # First merge background with canvas, then add shapes, images and texts
+    # First merge background with canvas, then add shapes and images
     LOG.info("Merging background to the canvas...")
-    _merge_elements(canvas, background, (x_axis, y_axis))
-    _merge_shapes(elements, canvas)
-    _merge_images(elements, canvas)
-    for text in elements.texts:   
-        _add_text(canvas, text)
+    with timed("background"):
+        _merge_elements(canvas, background, (x_axis, y_axis))
+    with timed("shapes"):
+        _merge_shapes(elements, canvas, plan)
+    _merge_images(elements, canvas, plan)
     
     return canvas
 
 
-def open_image(path: str|Path) -> Image:
-    """Create Image object out of the image file, either from url or file path"""
+def merge_texts(elements: ImageElements, canvas: Image, plan=None) -> Image:
+    """Add all texts on top of the image"""
+    
+    with timed("texts"):
+        for text in elements.texts:   
+            _add_text(canvas, text, plan)
+    
+    return canvas
+
+
+def open_image(path: str|Path, background_size: List = None) -> Image:
+    """Create Image object out of the image file, either from url or file path.
+    If background size from template is provided, image is decoded directly in that size"""
     
     LOG.info(f"Getting image from {path}")
     if path.startswith("https://") or path.startswith("http://"):
-        response = requests.get(path, stream=True)
-        if response.status_code in [200, 201]:
-            LOG.info(f"Image from {path} succefully retrieved.")
-            return Image.open(response.raw).convert("RGBA")
+        # Image is downloaded only once and then reused from the cache
+        with timed("download"):
+            cached_path = get_cached_image(path)
+        if cached_path is not None:
+            with timed("decode"):
+                return _decode_image(cached_path, background_size)
         else: 
             LOG.error(f"Image could not be retrieved from the url {path}")
             return None
     else:
         if os.path.exists(path):
-            return Image.open(path).convert("RGBA")
+            with timed("decode"):
+                return _decode_image(path, background_size)
         else:
             LOG.error(f"Image path {path} does not exist.")
             return None
 
 
-def _add_text(image: Image, text: Text) -> None:
+def _decode_image(path: str|Path, background_size: List = None) -> Image:
+    """Decode image file, downscale it during decoding as much as possible
+    and convert to RGBA only when it's already small"""
+    
+    file_size = os.path.getsize(path)
+    if file_size > MAX_IMAGE_BYTES:
+        LOG.error(f"Image {path} is too large: {file_size} B (max {MAX_IMAGE_BYTES} B).")
+        return None
+    
+    try:
+        # Only header is read here
+        image = Image.open(path)
+    except (OSError, Image.DecompressionBombError):
+        LOG.exception(f"Image {path} can not be opened.")
+        return None
+    
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        LOG.error(f"Image {path} has too many pixels: {image.size} (max {MAX_IMAGE_PIXELS}).")
+        return None
+    
+    if background_size is None:
+        return image.convert("RGBA")
+    
+    target = background_target_size(image.size, background_size)
+    
+    if image.format == "JPEG":
+        # Decoder itself scales the image down by 1/2, 1/4 or 1/8 (never below target)
+        image.draft("RGB", target)
+    else:
+        # Palette and other special modes can't be reduced and resized smoothly
+        if image.mode not in ["RGB", "RGBA", "L", "LA"]:
+            image = image.convert("RGBA")
+        factor = min(image.width // target[0], image.height // target[1])
+        if factor >= 2:
+            image = image.reduce(factor)
+    
+    if image.size != target:
+        # Lanczos is the sharpest filter when shrinking, bicubic is enough for enlarging
+        resample = Image.LANCZOS if image.width > target[0] else Image.BICUBIC
+        LOG.info(f"Resizing background image: '{image.size}' -> '{target}'")
+        image = image.resize(target, resample)
+    
+    return image.convert("RGBA")
+
+
+def load_background(path: str, size: List) -> Image:
+    """Get background image resized to the size from template,
+    decoded backgrounds are kept in memory so recreate doesn't need to open them again"""
+    
+    key = (path, tuple(size))
+    if os.path.exists(path):
+        # Local file can be changed
+        key += (os.path.getmtime(path),)
+    
+    background = BACKGROUNDS.get(key)
+    if background is not None:
+        LOG.info(f"Using already decoded background {path}")
+        return background
+    
+    # Image is decoded directly in the size needed for the story
+    background = open_image(path, size)
+    if background is None:
+        return None
+    
+    BACKGROUNDS.put(key, background)
+    return background
+
+
+def _add_text(image: Image, text: Text, plan=None) -> None:
     """Set all attributes of text and merge it to the canvas"""
     
     LOG.info(f"Adding text to the canvas: {text}")
@@ -187,12 +337,22 @@ def _add_text(image: Image, text: Text) -> None:
     if text.letter_case == "uppercase":
         text_str = text_str.upper()
     
-    font_size = text.font_size
+    get_font = lambda size: plan.font(text.font, size) if plan else ImageFont.truetype(text.font, size)
     
-    # split text if number of letters in line is exceeded
-    message = split_text(text_str, text.word_wrap)
+    if text.max_width and text.max_height:
+        # Auto-fit, the biggest font size the text fits into the box
+        min_size = min(text.min_font_size or 1, text.font_size)
+        font, message = fit_text(text_str, get_font, text.max_width, text.max_height, text.line_height, min_size, text.font_size)
+    elif text.max_width:
+        # split text if width of line in pixels is exceeded
+        font = get_font(text.font_size)
+        message = wrap_text(text_str, font, text.max_width)
+    else:
+        # split text if number of letters in line is exceeded
+        font = get_font(text.font_size)
+        message = split_text(text_str, text.word_wrap) if text.word_wrap else text_str.rstrip().split("\n")
     
-    font = ImageFont.truetype(text.font, text.font_size)
+    font_size = font.size
     align = text.align
     fill = text.color
     anchor = text.anchor
@@ -237,18 +397,84 @@ def horizontal_center(el_a: Image, el_b: Image) -> int:
     return -(el_b.width//2)+(el_a.width//2)
 
 
-def resize_background(background: Image, size: List) -> Image:
-    """Resize background image and keep size ratio"""
+def background_target_size(image_size: Tuple[int, int], size: List) -> Tuple[int, int]:
+    """Size of the background image resized by the template size, keeps size ratio"""
     
-    bg_width, bg_height = background.size
+    bg_width, bg_height = image_size
     if size[0] == "full":
         ratio = bg_height / size[1]
     else:
         ratio = bg_width / size[1]
+    
+    return (round(bg_width/ratio), round(bg_height/ratio))
+
+
+def resize_background(background: Image, size: List) -> Image:
+    """Resize background image and keep size ratio"""
+    
+    target = background_target_size(background.size, size)
+    LOG.info(f"Resizing background image: '{background.size}' -> '{target}'")
+    
+    return background.resize(target)
+
+
+def _scale(value: str|int|float, scale: float) -> str|int:
+    """Scale value in pixels, values like "center" or "full" are kept"""
+    
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return round(value * scale)
+    return value
+
 
-    LOG.info(f"Resizing background image: '{background.size}' -> '{size}'. Ratio: {ratio}")
+def scale_elements(elements: ImageElements, scale: float) -> ImageElements:
+    """Copy of the elements with all sizes and positions scaled down for the preview"""
+    
+    scaled = elements.model_copy(deep=True)
+    
+    scaled.canvas_size = Canvas(width=_scale(elements.canvas_size.width, scale), height=_scale(elements.canvas_size.height, scale))
+    
+    background = scaled.background
+    background.position = [_scale(x, scale) for x in background.position]
+    background.size = [_scale(x, scale) for x in background.size]
+    background.min_position_x = _scale(background.min_position_x, scale)
+    background.max_position_x = _scale(background.max_position_x, scale)
+    
+    for element in scaled.images or []:
+        element["position"] = [_scale(x, scale) for x in element["position"]]
+        if "size" in element:
+            element["size"] = [max(1, _scale(x, scale)) for x in element["size"]]
+    
+    for element in scaled.shapes or []:
+        element["position"] = [_scale(x, scale) for x in element["position"]]
+        element["size"] = [max(1, _scale(x, scale)) for x in element["size"]]
+        if "corner_radius" in element:
+            element["corner_radius"] = _scale(element["corner_radius"], scale)
+    
+    for text in scaled.texts:
+        text.font_size = max(1, _scale(text.font_size, scale))
+        text.y_axis = _scale(text.y_axis, scale)
+        text.x_axis = _scale(text.x_axis, scale)
+        if text.max_width:
+            text.max_width = max(1, _scale(text.max_width, scale))
+        if text.max_height:
+            text.max_height = max(1, _scale(text.max_height, scale))
+        if text.min_font_size:
+            text.min_font_size = max(1, _scale(text.min_font_size, scale))
+    
+    # Preview is encoded fast, size budget is applied only to the full resolution
+    if scaled.output is not None:
+        scaled.output.max_bytes = None
+    
+    return scaled
+
+
+def _unscale_background(elements: ImageElements, scaled: ImageElements, scale: float) -> None:
+    """Set background values computed while rendering the preview in the full resolution"""
     
-    return background.resize((round(bg_width/ratio) ,round(bg_height/ratio)))
+    if elements.background.position[0] == "center":
+        elements.background.position[0] = round(scaled.background.position[0] / scale)
+    elements.background.min_position_x = round(scaled.background.min_position_x / scale)
+    elements.background.max_position_x = round(scaled.background.max_position_x / scale)
 
 
 def draw_shape(details: Dict) -> Image:
@@ -266,36 +492,66 @@ def draw_shape(details: Dict) -> Image:
     return shape
 
 
-def create_story(post_elements: ImageElements, site: str) -> Path:
+def create_story(post_elements: ImageElements, site: str, plan=None, base: Image = None, workspace: str = None) -> Path:
     """Create and save image file. 
+    If base image (without texts) is provided, only texts are drawn on it.
+    If preview scale is set, image is rendered in the fraction of the canvas size.
     Returns True if image was saved"""
     
     is_ok = True
     
-    stories_site_dir = PROJECT_FOLDER / "stories" / site
-    image_path = f"{stories_site_dir}/{post_elements.number}.png"
+    stories_site_dir = stories_folder(site, workspace)
+    image_path = f"{stories_site_dir}/{story_filename(post_elements.number, post_elements.output)}"
     
-    # Create blank canvas as the base of the image
-    canvas = create_canvas(post_elements.canvas_size)
+    # Preview is rendered from the scaled copy, elements itself stay in the full resolution
+    scale = post_elements.preview_scale
+    render_elements = scale_elements(post_elements, scale) if scale else post_elements
+    
+    if base is not None:
+        LOG.info("Reusing image without texts, only texts will be drawn...")
+        story = base
+    else:
+        # Create blank canvas as the base of the image
+        canvas = create_canvas(render_elements.canvas_size)
+        
+        # Add elements from the template into the canvas
+        story = merge_base(render_elements, canvas, plan)
+        if story is not None:
+            if scale:
+                _unscale_background(post_elements, render_elements, scale)
+            # Keep image without texts for the case only texts are changed on recreate
+            with timed("composite_store"):
+                store_composite(base_key(post_elements), story)
     
-    # Add elements from the template into the canvas
-    story = merge_elements(post_elements, canvas)
     if story is None:
         LOG.error("Merging elements failed.")
         is_ok = False
+    else:
+        merge_texts(render_elements, story, plan)
     
     # Create stories dir if don't exist
     if not os.path.isdir(stories_site_dir):
         try:
             LOG.info(f"Creating folder -> {stories_site_dir}")
-            os.mkdir(stories_site_dir)
+            os.makedirs(stories_site_dir)
         except PermissionError as e:
             LOG.exception("Stories directory could not be created.")
             is_ok = False
     
     try:
         LOG.info(f"Storing generated image in file -> {image_path}")
-        story.save(image_path, format="png")
+        with timed("encode"):
+            data = encode_image(story, render_elements.output)
+        # Replaced instead of rewritten, the old file may be linked from the render cache
+        with timed("write"):
+            fd, tmp_path = tempfile.mkstemp(dir=stories_site_dir, prefix=".tmp_")
+            try:
+                with os.fdopen(fd, "wb") as image_f:
+                    image_f.write(data)
+                os.replace(tmp_path, image_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
     except IOError:
         LOG.exception(f"Image {image_path} can not be saved.")
         is_ok = False
@@ -0,0 +1,171 @@
+"""Headless generation of the stories of many sites and dates, e.g. by cron before editors arrive:
+
+    python -m src.cli --sites pe,ht --dates 2024-05-01,2024-05-02 --number 5 --output generated
+
+With --prerender, stories of the latest posts are only rendered in advance for the web interface (e.g. overnight).
+
+Sites are processed in parallel, stories of every site and date are copied into OUTPUT/<date>/<site>/
+and the run is described by the JSON report (OUTPUT/report.json by default).
+Exits with status 1 if stories of any site and date couldn't be created.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, List
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+
+def parse_args(args: List[str] = None) -> argparse.Namespace:
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+
+    parser = argparse.ArgumentParser(description="Create stories of the sites without the web interface.")
+    parser.add_argument("--sites", default=None, help="Comma separated sites, all sites with template by default.")
+    parser.add_argument("--dates", default=yesterday, help="Comma separated days (YYYY-MM-DD) of the posts, yesterday by default.")
+    parser.add_argument("--number", type=int, default=5, help="Number of stories of every site and day, 0 for all posts.")
+    parser.add_argument("--output", default="generated", help="Folder the stories are copied into.")
+    parser.add_argument("--report", default=None, help="Path to the JSON report, OUTPUT/report.json by default.")
+    parser.add_argument("--site-workers", type=int, default=4, help="Number of sites and dates processed at the same time.")
+    parser.add_argument("--fetch-workers", type=int, default=None, help="Number of concurrent wordpress requests (WPIG_FETCH_WORKERS).")
+    parser.add_argument("--prerender", action="store_true", help="Only render stories of the latest posts in advance for the web interface.")
+    parser.add_argument("--render-workers", type=int, default=None, help="Number of rendering processes, 0 renders in the same process (WPIG_RENDER_WORKERS).")
+    return parser.parse_args(args)
+
+
+def configure(options: argparse.Namespace) -> None:
+    """Worker counts are read by the modules when they are imported, so they are set first"""
+
+    # Paths in the templates of the sites
+    os.environ.setdefault("W2I_PATH", str(Path(__file__).parent.parent))
+
+    if options.fetch_workers is not None:
+        os.environ["WPIG_FETCH_WORKERS"] = str(options.fetch_workers)
+    if options.render_workers is not None:
+        os.environ["WPIG_RENDER_WORKERS"] = str(options.render_workers)
+
+
+def all_sites() -> List[str]:
+    from .file_paths import data_folder
+
+    return sorted(x.parent.name for x in data_folder().glob("*/template.yaml"))
+
+
+def generate(site: str, posts_from: str, number_posts: int, output: Path) -> Dict:
+    """Create stories of the site and day, copy them into the output folder.
+    Returns report of the run"""
+
+    from .archives import archive_files
+    from .file_paths import stories_folder, workspaces_folder
+    from .metadata_store import remove_workspace_metadata
+    from .pipeline import generate_stories
+    from .timings import collect
+    from .workspaces import new_workspace
+
+    report = {"site": site, "date": posts_from, "status": "ok", "error": None, "stories": [], "files": []}
+    started = time.perf_counter()
+    # Every run has its own workspace, so sites and dates don't overwrite each other
+    workspace = new_workspace()
+
+    LOG.info(f"Creating stories of '{site}' from {posts_from}...")
+    try:
+        with collect() as timings:
+            for event in generate_stories(site, [], number_posts, posts_from, workspace):
+                if event["event"] == "error":
+                    report.update(status="error", error=event["error"])
+                elif event["event"] == "story":
+                    report["stories"].append(event["story"])
+
+        if report["status"] == "ok":
+            target = output / posts_from / site
+            shutil.rmtree(target, ignore_errors=True)
+            os.makedirs(target)
+            for path in archive_files(stories_folder(site, workspace)):
+                shutil.copy2(path, target / path.name)
+                report["files"].append(str(target / path.name))
+        report["timings"] = timings.totals()
+    except Exception as e:
+        LOG.exception(f"Stories of '{site}' from {posts_from} couldn't be created.")
+        report.update(status="error", error=str(e))
+    finally:
+        shutil.rmtree(workspaces_folder() / workspace, ignore_errors=True)
+        remove_workspace_metadata(workspace)
+
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    LOG.info(f"Stories of '{site}' from {posts_from}: {report['status']}, {len(report['stories'])} created in {report['seconds']} s.")
+    return report
+
+
+def main(args: List[str] = None) -> int:
+    options = parse_args(args)
+    configure(options)
+
+    sites = [x for x in options.sites.split(",") if x] if options.sites else all_sites()
+    dates = [x for x in options.dates.split(",") if x]
+    for posts_from in dates:
+        # Invalid date fails the whole run before anything is fetched
+        datetime.strptime(posts_from, "%Y-%m-%d")
+
+    output = Path(options.output).resolve()
+    report_path = Path(options.report).resolve() if options.report else output / "report.json"
+    os.makedirs(output, exist_ok=True)
+
+    started_at = datetime.now().isoformat(timespec="seconds")
+    started = time.perf_counter()
+
+    if options.prerender:
+        from .prerender import prerender_all
+
+        summaries = prerender_all(sites)
+        report = {"started_at": started_at, "seconds": round(time.perf_counter() - started, 3), "prerendered": summaries}
+        os.makedirs(report_path.parent, exist_ok=True)
+        with open(report_path, "w") as report_f:
+            json.dump(report, report_f, indent=2)
+        LOG.info(f"Stories pre-rendered, report written to '{report_path}'")
+        return 1 if any("error" in x for x in summaries) else 0
+
+    jobs = [(site, posts_from) for posts_from in dates for site in sites]
+    with ThreadPoolExecutor(max_workers=max(1, options.site_workers), thread_name_prefix="site") as executor:
+        runs = list(executor.map(lambda job: generate(job[0], job[1], options.number, output), jobs))
+
+    failed = [x for x in runs if x["status"] != "ok"]
+    report = {
+        "started_at": started_at,
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+        "seconds": round(time.perf_counter() - started, 3),
+        "config": {
+            "sites": sites,
+            "dates": dates,
+            "number": options.number,
+            "output": str(output),
+            "site_workers": options.site_workers,
+            "env": {k: v for k, v in sorted(os.environ.items()) if k.startswith("WPIG_") and "PASSWORD" not in k},
+        },
+        "stories": sum(len(x["stories"]) for x in runs),
+        "failed": len(failed),
+        "runs": runs,
+    }
+
+    os.makedirs(report_path.parent, exist_ok=True)
+    with open(report_path, "w") as report_f:
+        json.dump(report, report_f, indent=2, default=str)
+    LOG.info(f"Created {report['stories']} stories of {len(jobs)} sites and dates, report written to '{report_path}'")
+
+    for run in failed:
+        LOG.error(f"Stories of '{run['site']}' from {run['date']} failed: {run['error']}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    LOG.setLevel(logging.INFO)
+    sys.exit(main())
@@ -1,10 +1,14 @@
 """Collects all neccessary data and calls function for creating image file out of them"""
 
+import multiprocessing
 import os
 import logging
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 from urllib.parse import quote
 
 from envyaml import EnvYAML
@@ -12,8 +16,14 @@ from pydantic import BaseModel
 
 from .canvas import Canvas, ImageElements, Background, Text
 from .canvas import create_story
-from .file_paths import template_path, clear_files
+from .encoders import EXTENSIONS, story_filename
+from .file_paths import template_path, clear_files, stories_folder
 from .get_posts_metadata import PostData
+from .prerender_cache import take_prerendered
+from .render_cache import get_rendered, put_rendered, render_cache_key
+from .render_plan import get_render_plan
+from .render_state import base_key, render_key, load_composite, load_manifest, save_manifest
+from .timings import collect, replay, timed
 
 
 SCRIPT_FOLDER = Path(__file__).parent
@@ -23,6 +33,15 @@ LOG = logging.getLogger(__name__)
 handler = logging.StreamHandler(sys.stdout)
 LOG.addHandler(handler)
 
+# Number of processes rendering stories in parallel, 0 renders them one by one in the worker itself
+RENDER_WORKERS = int(os.getenv("WPIG_RENDER_WORKERS", "0"))
+
+# Fraction of the canvas size previews are rendered in (stories editor), 0 or 1 disables previews
+PREVIEW_SCALE = float(os.getenv("WPIG_PREVIEW_SCALE", "0.35"))
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
 class Template(BaseModel):
     """Configuration of image - 
     images paths, sizes, positions, all settings for everything in the image"""
@@ -32,6 +51,7 @@ class Template(BaseModel):
     background: Dict
     texts_config: Optional[List]
     link_suffix: str | None
+    output: Optional[Dict] = None
 
 
 def get_story_template(site: str) -> dict:
@@ -43,6 +63,9 @@ def get_story_template(site: str) -> dict:
         LOG.exception("Template file couldn't be loaded.")
         return None
     
+    # Compile fonts, images and shapes of the template, so they are ready for stories creation
+    get_render_plan(site)
+    
     # Load texts
     if "texts" in template["elements"]:
         texts_config = template["elements"]["texts"]
@@ -55,6 +78,12 @@ def get_story_template(site: str) -> dict:
     else:
         suffix = None
     
+    # Load format of the image files if defined (PNG otherwise)
+    if "output" in template:
+        output = template["output"]
+    else:
+        output = None
+    
     # Create template object with configuration
     try:
         return Template(
@@ -62,7 +91,8 @@ def get_story_template(site: str) -> dict:
             elements = template["elements"],
             background = template["elements"]["background"],
             texts_config = texts_config,
-            link_suffix=suffix
+            link_suffix=suffix,
+            output=output
         ).model_dump()
     except Exception as e:
         LOG.exception("Error while creating template object.")
@@ -116,7 +146,10 @@ def get_post_elements(number: int, post: PostData, template: Template) -> dict:
             y_axis=text_conf["y_axis"],
             x_axis=text_conf["x_axis"],
             line_height=text_conf["line_height"],
-            word_wrap=text_conf["word_wrap"],
+            word_wrap=text_conf.get("word_wrap"),
+            max_width=text_conf.get("max_width"),
+            max_height=text_conf.get("max_height"),
+            min_font_size=text_conf.get("min_font_size"),
             anchor=text_conf["anchor"]
             ))
     
@@ -134,7 +167,9 @@ def get_post_elements(number: int, post: PostData, template: Template) -> dict:
             images=template.elements["images"],
             shapes=shapes,
             texts=texts,
-            post_url=quote(link)
+            post_url=quote(link),
+            post_id=post.post_id,
+            output=template.output
         ).model_dump())
 
 
@@ -148,6 +183,7 @@ def store_metadata(elements: ImageElements) -> Dict:
     texts = [x.text for x in elements.texts]
     return {
         "number": elements.number,
+        "filename": story_filename(elements.number, elements.output),
         "url": f"{elements.post_url}",
         "image": f"{elements.background.path}",
         "image_position_x":elements.background.position[0],
@@ -196,54 +232,274 @@ def adjust_elements(elements: ImageElements, metadata: Dict) -> ImageElements:
     return elements.model_dump()
         
 
-def create_stories(site: str, posts_elements: List[ImageElements]) -> List:
+def set_preview(posts_elements: List[ImageElements], preview: bool) -> None:
+    """Render stories as low resolution previews, or in the full resolution"""
+    
+    scale = PREVIEW_SCALE if preview and 0 < PREVIEW_SCALE < 1 else None
+    for elements in posts_elements:
+        elements.preview_scale = scale
+
+
+def get_render_pool() -> Optional[ProcessPoolExecutor]:
+    """Process pool shared by all requests of the worker, None if parallel rendering is disabled"""
+    
+    global _render_pool
+    
+    if RENDER_WORKERS < 1:
+        return None
+    
+    with _render_pool_lock:
+        if _render_pool is None:
+            LOG.info(f"Starting render pool with {RENDER_WORKERS} processes...")
+            # spawn - forking of the (gevent) worker with its threads and sockets is not safe
+            _render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS, 
+                mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _render_pool
+
+
+def _reset_render_pool() -> None:
+    """Drop broken pool, new one is started on the next request"""
+    
+    global _render_pool
+    
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+
+def _create_story(elements: ImageElements, site: str, reuse_base: bool, workspace: str = None) -> bool:
+    """Create story, draw only texts on the stored image if background, shapes and images were not changed"""
+    
+    base = None
+    if reuse_base:
+        with timed("composite_load"):
+            base = load_composite(base_key(elements))
+    return create_story(elements, site, get_render_plan(site), base, workspace)
+
+
+def _render_story(elements_json: Dict, site: str, reuse_base: bool, workspace: str = None) -> Tuple[bool, Dict, List]:
+    """Create single story in the render process.
+    Returns elements as well, because their values are changed during creation, and timings of the stages"""
+    
+    elements = ImageElements.model_validate(elements_json)
+    with collect() as timings:
+        is_ok = _create_story(elements, site, reuse_base, workspace)
+    return is_ok, elements.model_dump(), timings.events
+
+
+def _render_serial(elements: ImageElements, site: str, reuse_base: bool, workspace: str = None) -> Tuple[bool, ImageElements, Dict]:
+    with collect() as timings:
+        is_ok = _create_story(elements, site, reuse_base, workspace)
+    return is_ok, elements, timings.totals()
+
+
+def iter_render_stories(site: str, posts_elements: List[ImageElements], reuse_base: List[bool] = None, workspace: str = None) -> Iterator[Tuple[bool, ImageElements, Dict]]:
+    """Create images of all stories, in parallel if render pool is enabled.
+    Stories rendered before with the same elements and template files are taken from the render cache.
+    Results (with timings of the stages in ms) are yielded in the same order as posts_elements, each one as soon as it is created"""
+    
+    if reuse_base is None:
+        reuse_base = [False] * len(posts_elements)
+    
+    output_folder = stories_folder(site, workspace)
+    keys = {}
+    cached = {}
+    for elems in posts_elements:
+        with collect() as timings:
+            with timed("render_cache"):
+                keys[elems.number] = render_cache_key(elems)
+                is_cached = get_rendered(keys[elems.number], elems, output_folder / story_filename(elems.number, elems.output))
+        if is_cached:
+            cached[elems.number] = timings.totals()
+    
+    to_render = [(x, reuse) for x, reuse in zip(posts_elements, reuse_base) if x.number not in cached]
+    rendered = _iter_rendered(site, [x[0] for x in to_render], [x[1] for x in to_render], workspace)
+    for elems in posts_elements:
+        if elems.number in cached:
+            yield True, elems, cached[elems.number]
+            continue
+        
+        is_ok, elems, timings = next(rendered)
+        if is_ok:
+            put_rendered(keys[elems.number], elems, output_folder / story_filename(elems.number, elems.output))
+        yield is_ok, elems, timings
+
+
+def _iter_rendered(site: str, posts_elements: List[ImageElements], reuse_base: List[bool], workspace: str = None) -> Iterator[Tuple[bool, ImageElements, Dict]]:
+    """Render images of the stories, results are yielded in the same order as posts_elements"""
+    
+    done = 0
+    pool = get_render_pool()
+    if pool is not None:
+        try:
+            futures = [pool.submit(_render_story, x.model_dump(), site, reuse, workspace) for x, reuse in zip(posts_elements, reuse_base)]
+            for future in futures:
+                is_ok, elems, events = future.result()
+                done += 1
+                # Metrics of the render processes are not exported, stages are recorded in this process
+                with collect() as timings:
+                    replay(events)
+                yield is_ok, ImageElements.model_validate(elems), timings.totals()
+        except BrokenProcessPool:
+            LOG.exception("Render pool is broken, remaining stories will be created one by one.")
+            _reset_render_pool()
+    
+    # Stories not created by the render pool
+    for elems, reuse in list(zip(posts_elements, reuse_base))[done:]:
+        yield _render_serial(elems, site, reuse, workspace)
+
+
+def render_stories(site: str, posts_elements: List[ImageElements], reuse_base: List[bool] = None, workspace: str = None) -> List[Tuple[bool, ImageElements, Dict]]:
+    """Create images of all stories, results are in the same order as posts_elements"""
+    
+    return list(iter_render_stories(site, posts_elements, reuse_base, workspace))
+
+
+def _plan_incremental(posts_elements: List[ImageElements], manifest: Dict, output_folder: Path) -> Tuple[Dict, List[bool]]:
+    """Compare elements with the last rendered ones.
+    Returns stories which don't need to be created again and for the others whether only texts were changed"""
+    
+    unchanged = {}
+    reuse_base = []
+    for elems in posts_elements:
+        previous = manifest.get(elems.number)
+        image_exists = (output_folder / story_filename(elems.number, elems.output)).exists()
+        
+        if previous is not None and image_exists and previous["render_key"] == render_key(elems):
+            LOG.info(f"Story {elems.number} was not changed, it will not be created again.")
+            unchanged[elems.number] = previous
+            continue
+        
+        if previous is not None and previous["base_key"] == base_key(elems):
+            LOG.info(f"Only texts were changed in the story {elems.number}.")
+            # Values computed while merging background are needed for metadata
+            elems.background.min_position_x = previous["elements"]["background"]["min_position_x"]
+            elems.background.max_position_x = previous["elements"]["background"]["max_position_x"]
+            reuse_base.append(True)
+        else:
+            reuse_base.append(False)
+    
+    return unchanged, reuse_base
+
+
+def _remove_stale_stories(manifest: Dict, posts_elements: List[ImageElements], output_folder: Path) -> None:
+    """Remove images of stories which are not part of the recreated set anymore"""
+    
+    numbers = {x.number for x in posts_elements}
+    for number in manifest:
+        if number in numbers:
+            continue
+        for extension in EXTENSIONS.values():
+            image_path = output_folder / f"{number}{extension}"
+            if image_path.exists():
+                LOG.info(f"Removing story which is not recreated -> {image_path}")
+                os.remove(image_path)
+
+
+def create_stories(site: str, posts_elements: List[ImageElements], incremental: bool = False, workspace: str = None) -> List:
     """Call function for creating image for every single entry in the posts_elements 
-    and return data about created images"""
+    and return data about created images.
+    If incremental, only stories changed since the last creation are created again"""
+    
+    stories = iter_create_stories(site, posts_elements, incremental, workspace)
+    if stories is None:
+        return None
+    
+    metadata = list(stories)
     
-    # remove all previously created stories
-    # consider changing it with deleting them always after session's closed, 
-    # or storing them in the tmp dir which is deleted at the session end
-    clear_files(site)
+    LOG.info(f"Successfully created {len(metadata)} images.")
+    return metadata
+
+
+def iter_create_stories(site: str, posts_elements: List[ImageElements], incremental: bool = False, workspace: str = None) -> Optional[Iterator[Dict]]:
+    """Prepare output folder and return iterator creating the stories.
+    Metadata of every created image is yielded as soon as the image is created.
+    Returns None if output folder couldn't be prepared"""
     
-    metadata = []
+    # remove all previously created stories of the workspace
+    # (whole workspace is removed when it's not used for some time)
+    manifest = load_manifest(site, workspace) if incremental else {}
+    if not manifest:
+        clear_files(site, workspace)
     
-    # Check if stories folder exists and create it if not
-    stories_dir = PROJECT_FOLDER / "stories"
-    if not stories_dir.exists():
-        LOG.info(f"Creating folder -> {str(stories_dir)}")
+    # Check if site specific story folder (in the workspace) exists and create it if not
+    # (before rendering, so parallel render processes don't race to create it)
+    output_folder = stories_folder(site, workspace)
+    if not os.path.isdir(output_folder):
+        LOG.info(f"Creating output folder: {str(output_folder)}")
         try:
-            os.mkdir(stories_dir)
-        except PermissionError as e:
-            LOG.exception(f"Error during folder creation -> {str(stories_dir)}")
+            os.makedirs(output_folder)
+        except PermissionError as pe:
+            LOG.exception("Failed creating output folder.")
+            return None
+        except Exception as e:
+            LOG.exception(f"Error during folder creation -> {str(output_folder)}")
             return None
     
+    return _iter_created_stories(site, posts_elements, manifest, output_folder, workspace)
+
+
+def _iter_created_stories(site: str, posts_elements: List[ImageElements], manifest: Dict, output_folder: Path, workspace: str = None) -> Iterator[Dict]:
+    """Create stories and yield their metadata"""
+    
+    unchanged = {}
+    reuse_base = None
+    if manifest:
+        unchanged, reuse_base = _plan_incremental(posts_elements, manifest, output_folder)
+        _remove_stale_stories(manifest, posts_elements, output_folder)
+        # links file is written again for all stories
+        if (output_folder / "links.txt").exists():
+            os.remove(output_folder / "links.txt")
+        # Manifest is valid again only after all stories are created
+        save_manifest(site, {}, workspace)
+    
+    # Stories rendered in advance are only copied
+    changed = [x for x in posts_elements if x.number not in unchanged]
+    prerendered = take_prerendered(site, changed, output_folder)
+    if reuse_base is not None:
+        reuse_base = [reuse for x, reuse in zip(changed, reuse_base) if x.number not in prerendered]
+    
+    to_render = [x for x in changed if x.number not in prerendered]
+    rendered = iter_render_stories(site, to_render, reuse_base, workspace)
+    
+    new_manifest = {}
+    
+    # Results are processed in the original order, so links file is always the same
     for elems in posts_elements:
-        # Create single image
-        if not create_story(elems, site):
+        if elems.number in unchanged:
+            # Take values computed during the last creation
+            previous = ImageElements.model_validate(unchanged[elems.number]["elements"])
+            elems.background = previous.background
+            is_ok = True
+            timings = {}
+        elif elems.number in prerendered:
+            elems = prerendered[elems.number]
+            is_ok = True
+            timings = {}
+        else:
+            is_ok, elems, timings = next(rendered)
+        
+        if not is_ok:
             LOG.error(f"Image creation failed -> elements: {elems}")
             continue
         
-        # Check if site specific story folder exists and create it if not
-        output_folder = stories_dir / site
-        if not os.path.isdir(output_folder):
-            LOG.info(f"Creating output folder: {str(output_folder)}")
-            try:
-                os.mkdir(output_folder)
-            except PermissionError as pe:
-                LOG.exception("Failed creating output folder.")
-                return None
-            except Exception as e:
-                LOG.exception(f"Error during folder creation -> {str(output_folder)}")
-                return None
-                
-        
         # create file with links to posts
         # needed when downloading stories 
         with open(output_folder / "links.txt", "a") as links:
             links.write(f"{elems.number}: {elems.post_url}\n")
 
-        metadata.append(store_metadata(elems))
-
-    LOG.info(f"Successfully created {len(metadata)} images.")
-    return metadata
+        new_manifest[elems.number] = {
+            "render_key": render_key(elems),
+            "base_key": base_key(elems),
+            "elements": elems.model_dump(),
+        }
+        story = store_metadata(elems)
+        # Duration of the stages of the story creation in ms (empty if it was not created again)
+        story["timings"] = timings
+        yield story
+    
+    save_manifest(site, new_manifest, workspace)
         
\ No newline at end of file
@@ -3,6 +3,9 @@ import os
 import sys
 from pathlib import Path
 
+from .encoders import MIMETYPES
+from .file_paths import stories_folder
+
 SCRIPT_FOLDER = Path(__file__).parent
 PROJECT_FOLDER = SCRIPT_FOLDER.parent
 
@@ -11,11 +14,12 @@ handler = logging.StreamHandler(sys.stdout)
 LOG.addHandler(handler)
 
 
-def delete_story_file(metadata, site):
-    """Deletes png file and all stored data related to the selected story"""
+def delete_story_file(metadata, site, workspace=None):
+    """Deletes image file and all stored data related to the selected story"""
     
-    stories_dir = PROJECT_FOLDER / "stories" / site
-    file_path = stories_dir / (str(metadata["number"]) + ".png")
+    stories_dir = stories_folder(site, workspace)
+    # Stories created before output format was configurable have no filename in metadata
+    file_path = stories_dir / metadata.get("filename", str(metadata["number"]) + ".png")
     
     # Check if file exist
     if not file_path.exists():
@@ -33,33 +37,28 @@ def delete_story_file(metadata, site):
     return True
 
 
-def reorder_stories(metadata: list, site: str) -> list:
-    """Fixes order of files and metadatas after story was deleted"""
+def reorder_stories(site: str, workspace: str = None) -> bool:
+    """Fixes order of files after story was deleted (metadata are renumbered by the metadata store)"""
     
-    stories_dir = PROJECT_FOLDER / "stories" / site
+    stories_dir = stories_folder(site, workspace)
     
     # Rename files to keep correct (ascending) order
-    files = [x for x in os.listdir(stories_dir) if os.path.splitext(x)[1] == ".png"]
+    files = [x for x in os.listdir(stories_dir) if os.path.splitext(x)[1] in MIMETYPES and not x.startswith(".")]
     # Sort filenames in the correct way (so 10.png is not right after 1.png)
     files.sort(key=lambda f: int(''.join(filter(str.isdigit, f))))
     
-    LOG.info("Reordering files and stored metadata...")
+    LOG.info("Reordering files...")
     
     for i, filename in enumerate(files):
-        if os.path.splitext(filename)[0] == str(i):
+        name, extension = os.path.splitext(filename)
+        if name == str(i):
             continue
         try:
-            LOG.info(f"Renaming file '{str(stories_dir / filename)}' -> '{str(stories_dir / (str(i)+'.png'))}'")
-            os.rename(stories_dir / filename, stories_dir / (str(i)+".png"))
+            LOG.info(f"Renaming file '{str(stories_dir / filename)}' -> '{str(stories_dir / (str(i)+extension))}'")
+            os.rename(stories_dir / filename, stories_dir / (str(i)+extension))
         except IOError as e:
-            LOG.exception(f"File '{filename}' can not be renamed to '{i}.png'")
+            LOG.exception(f"File '{filename}' can not be renamed to '{i}{extension}'")
             return None
         
-    # Fix metadata numbers order
-    for i, story_data in enumerate(metadata):
-        if story_data["number"] == i:
-            continue
-        story_data["number"] = i
-        
-    return metadata
+    return True
             
\ No newline at end of file
@@ -0,0 +1,108 @@
+"""Downloading of the files with bounded time and size"""
+
+import logging
+import os
+import sys
+import time
+from typing import Dict, Optional
+
+import requests
+
+from .fetch_engine import get_session
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+CONNECT_TIMEOUT = float(os.getenv("WPIG_DOWNLOAD_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("WPIG_DOWNLOAD_READ_TIMEOUT", "20"))
+# Whole download (including retries) must finish within this time (seconds)
+DOWNLOAD_DEADLINE = float(os.getenv("WPIG_DOWNLOAD_DEADLINE", "60"))
+MAX_DOWNLOAD_BYTES = int(os.getenv("WPIG_MAX_IMAGE_BYTES", str(40 * 1024 * 1024)))
+RETRIES = int(os.getenv("WPIG_DOWNLOAD_RETRIES", "3"))
+BACKOFF = 0.5
+
+CHUNK_SIZE = 64 * 1024
+
+# Statuses worth trying again
+_TRANSIENT_STATUSES = [429, 500, 502, 503, 504]
+_TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class Download:
+    """Downloaded file"""
+
+    def __init__(self, status_code: int, headers: Dict, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+class _TooLarge(Exception):
+    pass
+
+
+class _DeadlineExceeded(Exception):
+    pass
+
+
+def _download_once(url: str, headers: Dict, max_bytes: int, deadline: float) -> Download:
+    with get_session().get(url, headers=headers, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+        if response.status_code not in [200, 201]:
+            return Download(response.status_code, response.headers, b"")
+
+        # Refuse too large file before downloading it
+        content_length = response.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise _TooLarge(f"Content-Length {content_length} B")
+
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise _TooLarge(f"more than {max_bytes} B received")
+            if time.monotonic() > deadline:
+                raise _DeadlineExceeded()
+            chunks.append(chunk)
+
+        return Download(response.status_code, response.headers, b"".join(chunks))
+
+
+def download(url: str, headers: Dict = None, max_bytes: int = MAX_DOWNLOAD_BYTES) -> Optional[Download]:
+    """Download file through the shared session.
+    Transient errors are retried with backoff, too large or too slow downloads are aborted.
+    Returns None if file couldn't be downloaded"""
+
+    deadline = time.monotonic() + DOWNLOAD_DEADLINE
+
+    for attempt in range(RETRIES + 1):
+        if attempt:
+            delay = BACKOFF * 2 ** (attempt - 1)
+            if time.monotonic() + delay > deadline:
+                break
+            LOG.info(f"Retrying download of {url} in {delay} s...")
+            time.sleep(delay)
+
+        try:
+            result = _download_once(url, headers or {}, max_bytes, deadline)
+        except _TooLarge as e:
+            LOG.error(f"File {url} is too large ({e}), download aborted.")
+            return None
+        except _DeadlineExceeded:
+            LOG.error(f"Download of {url} took more than {DOWNLOAD_DEADLINE} s, download aborted.")
+            return None
+        except _TRANSIENT_ERRORS:
+            LOG.warning(f"Download of {url} failed (attempt {attempt + 1}).", exc_info=True)
+            continue
+        except requests.RequestException:
+            LOG.exception(f"File could not be downloaded from the url {url}")
+            return None
+
+        if result.status_code in _TRANSIENT_STATUSES:
+            LOG.warning(f"Download of {url} returned {result.status_code} (attempt {attempt + 1}).")
+            continue
+        return result
+
+    LOG.error(f"File could not be downloaded from the url {url}")
+    return None
@@ -0,0 +1,118 @@
+"""Encoding of the created images into PNG, JPEG or WebP files"""
+
+import io
+import logging
+import sys
+from typing import Optional
+
+from PIL import Image
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+EXTENSIONS = {
+    "png": ".png",
+    "jpeg": ".jpg",
+    "webp": ".webp",
+}
+
+MIMETYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".webp": "image/webp",
+}
+
+# Lowest quality used when searching for the quality fitting into the size budget
+MIN_QUALITY = 40
+# Palette sizes tried when PNG doesn't fit into the size budget
+PNG_COLORS = [256, 128, 64, 32]
+
+
+def file_extension(output=None) -> str:
+    """Extension of the image file by output settings (PNG by default)"""
+
+    if output is None:
+        return ".png"
+    return EXTENSIONS[output.format]
+
+
+def story_filename(number: int, output=None) -> str:
+    return f"{number}{file_extension(output)}"
+
+
+def _encode_png(image: Image.Image, optimize: bool, colors: Optional[int]) -> bytes:
+    if colors:
+        # Palette image is a fraction of the size of the RGBA one
+        image = image.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+    buffer = io.BytesIO()
+    image.save(buffer, format="png", optimize=optimize)
+    return buffer.getvalue()
+
+
+def _encode_lossy(image: Image.Image, format: str, quality: int, optimize: bool) -> bytes:
+    # Stories don't have transparency, JPEG doesn't support it at all
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    if format == "jpeg":
+        image.save(buffer, format="jpeg", quality=quality, optimize=optimize, progressive=True)
+    else:
+        image.save(buffer, format="webp", quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def _fit_lossy(image: Image.Image, output) -> bytes:
+    """Binary search for the highest quality fitting into the size budget"""
+
+    image = image.convert("RGB")
+    best = None
+    low, high = MIN_QUALITY, output.quality
+    while low <= high:
+        quality = (low + high) // 2
+        data = _encode_lossy(image, output.format, quality, output.optimize)
+        if len(data) <= output.max_bytes:
+            best = data
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if best is None:
+        LOG.warning(f"Image doesn't fit into {output.max_bytes} B even with quality {MIN_QUALITY}.")
+        best = _encode_lossy(image, output.format, MIN_QUALITY, output.optimize)
+    return best
+
+
+def _fit_png(image: Image.Image, output) -> bytes:
+    """Use smaller palettes until the image fits into the size budget"""
+
+    data = _encode_png(image, output.optimize, output.colors)
+    for colors in PNG_COLORS:
+        if len(data) <= output.max_bytes:
+            return data
+        if output.colors and colors >= output.colors:
+            continue
+        data = _encode_png(image, output.optimize, colors)
+
+    if len(data) > output.max_bytes:
+        LOG.warning(f"Image doesn't fit into {output.max_bytes} B even with {PNG_COLORS[-1]} colors.")
+    return data
+
+
+def encode_image(image: Image.Image, output=None) -> bytes:
+    """Encode image by output settings.
+    Encoder releases GIL, so images can be encoded in parallel threads as well as processes"""
+
+    if output is None:
+        buffer = io.BytesIO()
+        image.save(buffer, format="png")
+        return buffer.getvalue()
+
+    if output.max_bytes:
+        if output.format == "png":
+            return _fit_png(image, output)
+        return _fit_lossy(image, output)
+
+    if output.format == "png":
+        return _encode_png(image, output.optimize, output.colors)
+    return _encode_lossy(image, output.format, output.quality, output.optimize)
@@ -0,0 +1,192 @@
+"""Shared HTTP session and concurrent fetching of the wordpress api resources"""
+
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from .api_cache import CachedResponse, endpoint_ttl, get_api_cache
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Max number of requests running against one host at the same time
+MAX_CONNECTIONS_PER_HOST = int(os.getenv("WPIG_MAX_CONNECTIONS_PER_HOST", "6"))
+# Number of workers used for fan-out of the requests
+FETCH_WORKERS = int(os.getenv("WPIG_FETCH_WORKERS", "16"))
+# (connect, read) timeout in seconds
+REQUEST_TIMEOUT = (5, 30)
+
+_session = None
+_session_lock = threading.Lock()
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Keep-alive session shared by all requests of the worker"""
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            LOG.info("Creating shared HTTP session...")
+            session = requests.Session()
+            # Keep enough connections in the pool for all concurrent requests to one host
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(MAX_CONNECTIONS_PER_HOST, 10))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+def _host_limit(url: str) -> threading.BoundedSemaphore:
+    """Semaphore limiting the number of concurrent requests to the host of the url"""
+
+    host = urlparse(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return _host_limits[host]
+
+
+def _request(url: str, params: Optional[Dict] = None, headers: Optional[Dict] = None) -> Optional[requests.Response]:
+    """Send GET request through the shared session, respecting per-host limit"""
+
+    with _host_limit(url):
+        try:
+            return get_session().get(url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException:
+            LOG.exception(f"Request to '{url}' failed.")
+            return None
+
+
+def _cached_response(url: str, cached: CachedResponse) -> requests.Response:
+    """Create response object out of the cached one, so callers can't tell the difference"""
+
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(cached.headers)
+    response.encoding = "utf-8"
+    response._content = cached.body
+    return response
+
+
+def fetch(url: str, params: Optional[Dict] = None) -> Optional[requests.Response]:
+    """Send GET request, successful responses are cached and revalidated when they get stale"""
+
+    cache = get_api_cache()
+    if cache is None:
+        return _request(url, params)
+
+    key = requests.Request("GET", url, params=params).prepare().url
+    try:
+        cached = cache.get(key)
+    except sqlite3.Error:
+        # Request doesn't fail only because the cache is not available
+        LOG.exception(f"Cached response for '{key}' couldn't be loaded.")
+        return _request(url, params)
+
+    # Fresh response doesn't need to be revalidated
+    if cached is not None and cached.is_fresh(endpoint_ttl(url)):
+        LOG.info(f"Using cached response for '{key}'")
+        return _cached_response(key, cached)
+
+    headers = cached.conditional_headers() if cached is not None else None
+    response = _request(url, params, headers)
+
+    if response is not None and response.status_code == 304 and cached is not None:
+        LOG.info(f"Cached response for '{key}' is still valid.")
+        try:
+            cache.refresh(key)
+        except sqlite3.Error:
+            LOG.exception(f"Cached response for '{key}' couldn't be refreshed.")
+        return _cached_response(key, cached)
+
+    if response is not None and response.status_code == 200:
+        try:
+            cache.put(key, response.content, dict(response.headers))
+        except sqlite3.Error:
+            LOG.exception(f"Response for '{key}' couldn't be cached.")
+
+    return response
+
+
+def fetch_json(url: str, params: Optional[Dict] = None) -> Any:
+    """Send GET request and return decoded json body, None if request was not successful"""
+
+    response = fetch(url, params)
+    if response is None:
+        return None
+
+    if response.status_code != 200:
+        LOG.warning(f"Unexpected response from '{url}': {response.text}")
+        return None
+
+    try:
+        return response.json()
+    except ValueError:
+        LOG.exception(f"Response from '{url}' is not valid json.")
+        return None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Worker pool reused by all fan-out calls"""
+
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="wp_fetch")
+    return _executor
+
+
+def map_concurrently(func: Callable, items: Iterable) -> List:
+    """Call function for every item in parallel, results are in the same order as items.
+    Must not be nested - function itself should not call map_concurrently"""
+
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    return list(_get_executor().map(func, items))
+
+
+def iter_concurrently(func: Callable, items: Iterable, window: int) -> Iterator:
+    """Call function for items in parallel (at most window calls at once), yield results in the same order as items.
+    Calls which were not started yet are cancelled once the caller stops iterating"""
+
+    items = iter(items)
+    executor = _get_executor()
+    pending = deque(executor.submit(func, item) for item in islice(items, max(1, window)))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            # Keep the window full while the caller processes the result
+            pending.extend(executor.submit(func, item) for item in islice(items, 1))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def fetch_many(urls: Iterable[str]) -> List:
+    """Fetch json from all urls in parallel, keep order of the urls"""
+
+    return map_concurrently(fetch_json, urls)
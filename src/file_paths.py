@@ -18,9 +18,43 @@ def project_folder() -> Path:
     return PROJECT_FOLDER
 
 
+def cache_folder() -> Path:
+    """Folder with cached data shared by all workers"""
+    return Path(os.getenv("WPIG_CACHE_FOLDER", PROJECT_FOLDER / "cache"))
+
+
+def jobs_folder() -> Path:
+    """Folder with state of the background jobs"""
+    return Path(os.getenv("WPIG_JOBS_FOLDER", PROJECT_FOLDER / "jobs"))
+
+
+def workspaces_folder() -> Path:
+    """Folder with workspaces of all sessions, in memory (tmpfs) if available"""
+    
+    if os.getenv("WPIG_WORKSPACES_FOLDER"):
+        return Path(os.getenv("WPIG_WORKSPACES_FOLDER"))
+    if os.access("/dev/shm", os.W_OK):
+        return Path("/dev/shm") / "wp2igstories"
+    return PROJECT_FOLDER / "workspaces"
+
+
+def stories_folder(site: str, workspace: str = None) -> Path:
+    """Folder with created stories of the site.
+    Every session has its own workspace, without workspace the shared folder is used"""
+    
+    if workspace is None:
+        return PROJECT_FOLDER / "stories" / site
+    return workspaces_folder() / workspace / site
+
+
+def data_folder() -> Path:
+    """Folder with templates of the sites"""
+    return Path(os.getenv("WPIG_DATA_FOLDER", PROJECT_FOLDER / "data"))
+
+
 def template_path(site: str) -> str:
     """Path to stories template file"""
-    return PROJECT_FOLDER / "data" / site / "template.yaml"
+    return data_folder() / site / "template.yaml"
 
 
 def predef_posts_file(site: str) -> str:
@@ -29,11 +63,11 @@ def predef_posts_file(site: str) -> str:
     return PROJECT_FOLDER / "stories" / site / "stories.yaml"
 
 
-def clear_files(site: str) -> None:
+def clear_files(site: str, workspace: str = None) -> None:
     """Remove created data"""
     
     ignore_files = ["metadata.yaml", "stories.yaml"]
-    output_folder = PROJECT_FOLDER / "stories" / site
+    output_folder = stories_folder(site, workspace)
     
     if not output_folder.exists():
         return None
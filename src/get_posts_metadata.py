@@ -1,16 +1,20 @@
 import logging
-import requests
 import os
+import sqlite3
 import sys
+import time
 from datetime import datetime, timedelta
 from html import unescape
-from typing import List, Dict
+from typing import Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
 
 import yaml
 from pydantic import BaseModel
 
+from .fetch_engine import fetch, fetch_json, fetch_many, iter_concurrently, map_concurrently
 from .file_paths import template_path, predef_posts_file
+from .post_index import PostIndex, POST_INDEX_DAYS, get_post_index
+from .timings import timed
 
 LOG = logging.getLogger(__name__)
 handler = logging.StreamHandler(sys.stdout)
@@ -18,6 +22,24 @@ LOG.addHandler(handler)
 
 POSTS_NUMBER = 5
 
+# "batched" - covers are embedded in the posts response, tags and slugs are resolved by one request
+# "concurrent" - every post, cover and tag is requested separately (in parallel)
+# "indexed" - posts are read from the local index of the site synced by the modified posts (otherwise as "batched")
+FETCH_MODE = os.getenv("WPIG_FETCH_MODE", "batched")
+
+# Maximum number of IDs or slugs requested by one query (wordpress rejects per_page over 100)
+INCLUDE_BATCH_SIZE = 100
+
+# Maximum number of posts in one page of wordpress api
+MAX_PER_PAGE = 100
+# Minimal number of posts requested in one page
+POSTS_PER_PAGE = int(os.getenv("WPIG_POSTS_PER_PAGE", "20"))
+# Number of pages of posts requested at the same time
+PAGES_IN_FLIGHT = int(os.getenv("WPIG_POSTS_PAGES_IN_FLIGHT", "4"))
+
+# Fields of the post needed for creating stories (_links are required by _embed)
+POST_FIELDS = "id,slug,link,title,featured_media,tags,_links,_embedded"
+
 
 def get_api_url(site: str) -> str:
     """get url for api connection from template.yaml"""
@@ -32,70 +54,152 @@ class Posts:
     def __init__(self, url):
         self.api_url = url
         
-    def has_wrong_tag(self, post_tags: List, exclude_tags: List) -> bool:
+    def get_tag_names(self, tag_ids: List) -> Dict:
+        """Get names of all tags by their IDs, one request per batch of IDs"""
+        
+        tag_ids = list(dict.fromkeys(tag_ids))
+        tag_names = {}
+        
+        for i in range(0, len(tag_ids), INCLUDE_BATCH_SIZE):
+            batch = tag_ids[i:i + INCLUDE_BATCH_SIZE]
+            params = {
+                "include": ",".join(str(x) for x in batch),
+                "per_page": len(batch),
+                "_fields": "id,name",
+            }
+            tags = fetch_json(f"{self.api_url}/tags", params=params)
+            if tags is None:
+                LOG.warning(f"Tags {batch} couldn't be retrieved.")
+                continue
+            tag_names.update({tag["id"]: tag["name"] for tag in tags})
+        
+        return tag_names
+        
+    def has_wrong_tag(self, post_tags: List, exclude_tags: List, tag_names: Dict = None) -> bool:
         """Check if the post has some tag which is in the ignore list"""
         
-        for tag_id in post_tags:
-            # Get a tag name by its ID
-            tag_api_url = f"{self.api_url}/tags/{tag_id}"
-            response = requests.get(tag_api_url)
-            if response.status_code != 200:
+        if tag_names is not None:
+            # Tag names were already resolved for all posts
+            tags = [{"name": tag_names[x]} if x in tag_names else None for x in post_tags]
+        else:
+            # Get all tag names by their IDs at once
+            tags = fetch_many([f"{self.api_url}/tags/{tag_id}" for tag_id in post_tags])
+        
+        for tag_id, tag in zip(post_tags, tags):
+            if tag is None:
                 continue
             
             # Then check if the tag name is in ignore list
-            tag = response.json()
             if tag["name"] in exclude_tags:
                 LOG.info(f"Tag: {tag['name']} with ID: {tag_id} found in post.")
                 return True
         return False
 
 
-    def get_latest_posts(self, posts_from: str) -> List:
+    def get_posts_page(self, params: Dict, page: int) -> Optional[Tuple[List, int]]:
+        """Get one page of the posts, returns posts and total number of pages"""
+        
+        posts_api_url = f"{self.api_url}/posts"
+        try:
+            response = fetch(posts_api_url, params=dict(params, page=page))
+            if response is not None and response.status_code == 200:
+                posts = response.json()
+                total_pages = int(response.headers.get("X-WP-TotalPages", 1))
+                # Exclude post content from the response to not overwhelm log
+                LOG.info(f"Posts retrieved (page {page}/{total_pages}):\n{[{k:v for k, v in post.items() if k != 'content'} for post in posts]}")
+                return posts, total_pages
+            else:
+                LOG.warning(f"Unexpected response: {response.text if response is not None else None}")
+                return None
+        
+        except:
+            LOG.exception(f"Failed to retrieve page {page} of the posts.")
+            return None
+
+    def iter_pages(self, params: Dict) -> Iterator[Optional[List]]:
         """
-        Retrieve list of the posts posted on previous day (max 20)
-        Returns all data retrieved from wordpress API
+        Retrieve all pages of the posts matching the parameters
+        First page tells the total number of pages, the remaining pages are requested concurrently
+        Yields pages in order, None for the page which couldn't be retrieved (stops requesting pages once the caller stops iterating)
         """
         
-        posts_api_url = f"{self.api_url}/posts"
-        LOG.info(f"Getting posts data from: '{posts_api_url}'")
+        first_page = self.get_posts_page(params, 1)
+        if first_page is None:
+            yield None
+            return
+        posts, total_pages = first_page
+        yield posts
         
-        # Get posts by user-selected date on the web
-        from_date = datetime.strptime(posts_from, '%Y-%m-%d')
-        to_date = from_date + timedelta(days=1)
+        pages = iter_concurrently(lambda page: self.get_posts_page(params, page), range(2, total_pages + 1), PAGES_IN_FLIGHT)
+        try:
+            for result in pages:
+                yield result[0] if result is not None else None
+        finally:
+            pages.close()
+
+    def iter_latest_posts(self, posts_from: str, per_page: int = POSTS_PER_PAGE) -> Iterator[List]:
+        """
+        Retrieve the posts posted on the selected day page by page
+        Yields pages in order, pages which couldn't be retrieved are skipped
+        """
         
-        if not from_date < datetime.today():
-            LOG.warning(f"Selected date is higher than today, setting date automatically for today...")
-            from_date = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+        LOG.info(f"Getting posts data from: '{self.api_url}/posts'")
+        
+        # Get posts by user-selected date on the web
+        from_date, to_date = posts_day(posts_from)
             
         params = {
-            "per_page": 20,
+            "per_page": min(per_page, MAX_PER_PAGE),
             "status": "publish",
             "before": to_date.isoformat(),
             "after": from_date.isoformat(),
         }
+        
+        # Get cover images inline with the posts
+        if FETCH_MODE != "concurrent":
+            params.update({"_embed": "wp:featuredmedia", "_fields": POST_FIELDS})
 
         LOG.info(f"Request parameters: {params}")
-
+        
+        pages = self.iter_pages(params)
         try:
-            response = requests.get(posts_api_url, params=params)
-            if response.status_code == 200:
-                posts = response.json()
-                # Exclude post content from the response to not overwhelm log
-                LOG.info(f"Posts retrieved:\n{[{k:v for k, v in post.items() if k != 'content'} for post in posts]}")
-                return posts
-            else:
-                LOG.warning(f"Unexpected response: {response.text}")
-                return None
+            for page, posts in enumerate(pages, start=1):
+                if posts is None:
+                    LOG.warning(f"Page {page} of the posts is skipped.")
+                    continue
+                yield posts
+        finally:
+            pages.close()
 
-            
-        except:
-            LOG.exception("Failed to retrieve posts.")
+    def get_latest_posts(self, posts_from: str) -> List:
+        """
+        Retrieve list of all posts posted on the selected day
+        Returns all data retrieved from wordpress API, None if no page was retrieved
+        """
+        
+        pages = list(self.iter_latest_posts(posts_from))
+        if not pages:
+            return None
+        return [post for page in pages for post in page]
+
+
+def posts_day(posts_from: str) -> Tuple[datetime, datetime]:
+    """Start and end of the selected day (YYYY-MM-DD)"""
+    
+    from_date = datetime.strptime(posts_from, '%Y-%m-%d')
+    to_date = from_date + timedelta(days=1)
+    
+    if not from_date < datetime.today():
+        LOG.warning(f"Selected date is higher than today, setting date automatically for today...")
+        from_date = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+    return from_date, to_date
 
 
 def get_valid_posts(api_url: str, pre_posts_len: int, number_posts: int, posts_from: str) -> List:
     """
     Get posts published on previous day (later any selected date)
     Then filter out only posts that meet criteria
+    Posts are filtered page by page, no more pages are requested once there are enough of them
     """
     
     # Create list of tag names that should be excluded
@@ -103,27 +207,193 @@ def get_valid_posts(api_url: str, pre_posts_len: int, number_posts: int, posts_f
     
     posts = Posts(api_url)
     
-    # Get all posts from previous day
-    posts_list = posts.get_latest_posts(posts_from)
-    if not posts_list:
-        LOG.error("Nepodarilo sa získať články")
+    # Number of posts still needed, None means all of them
+    wanted = number_posts - pre_posts_len if number_posts != 0 else None
+    if wanted is not None and wanted <= 0:
         return []
     
-    # Filter out posts with unwanted tags
-    for post in reversed(posts_list):
-        if exclude_tags is None:
-            break
-        
+    # Request only as many posts as needed (if some are filtered out, next page is requested)
+    per_page = max(wanted, POSTS_PER_PAGE) if wanted is not None else MAX_PER_PAGE
+    
+    posts_list = []
+    received = False
+    pages = posts.iter_latest_posts(posts_from, per_page)
+    try:
+        for page_posts in pages:
+            received = True
+            
+            # Resolve names of tags of all posts of the page at once
+            tag_names = None
+            if exclude_tags is not None and FETCH_MODE != "concurrent":
+                tag_names = posts.get_tag_names([x for post in page_posts for x in post["tags"]])
+            
+            # Filter out posts with unwanted tags
+            for post in page_posts:
+                if exclude_tags is not None:
+                    LOG.info(f"Filtering out posts with tags: {exclude_tags}")
+                    if posts.has_wrong_tag(post["tags"], exclude_tags, tag_names):
+                        LOG.info(f"Post {post['link']} will be skipped.")
+                        continue
+                posts_list.append(post)
+            
+            # Return selected number of posts or all of them
+            if wanted is not None and len(posts_list) >= wanted:
+                return posts_list[:wanted]
+    finally:
+        pages.close()
+    
+    if not received:
+        LOG.error("Nepodarilo sa získať články")
+    return posts_list
+
+def sync_post_index(site: str, api_url: str = None, force: bool = False) -> Optional[PostIndex]:
+    """
+    Pull posts modified since the last sync into the local index of the site (posts of last days on the first sync)
+    Sync is skipped if the index was synced recently, unless forced
+    Returns the index, None if it's not available
+    """
+    
+    index = get_post_index(site)
+    if index is None or not (force or index.is_stale()):
+        return index
+    
+    api_url = api_url or get_api_url(site)
+    posts = Posts(api_url)
+    state = index.state()
+    started = time.time()
+    
+    if "last_modified" in state:
+        # Posts modified in the same second as the last indexed one are requested again
+        modified_after = (datetime.fromisoformat(state["last_modified"]) - timedelta(seconds=1)).isoformat()
+        covered_from = state["covered_from"]
+    else:
+        covered_from = (datetime.today() - timedelta(days=POST_INDEX_DAYS)).strftime("%Y-%m-%d")
+        modified_after = f"{covered_from}T00:00:00"
+    
+    params = {
+        "per_page": MAX_PER_PAGE,
+        "status": "publish",
+        "modified_after": modified_after,
+        "orderby": "modified",
+        "order": "asc",
+        "_embed": "wp:featuredmedia",
+        "_fields": POST_FIELDS + ",date,modified",
+    }
+    LOG.info(f"Syncing post index of '{site}' (modified after {modified_after})...")
+    
+    changed = []
+    complete = True
+    for page in posts.iter_pages(params):
+        if page is None:
+            complete = False
+            continue
+        changed.extend(page)
+    
+    # Covers and tag names are resolved once, when the post is indexed
+    covers = get_post_covers(api_url, [x["featured_media"] for x in changed if _get_embedded_cover(x) is None])
+    for post in changed:
+        post["cover"] = _get_embedded_cover(post) or covers.get(post["featured_media"])
+    tag_names = posts.get_tag_names(index.missing_tags([x for post in changed for x in post.get("tags", [])]))
+    
+    new_state = {}
+    # Sync is complete only if all pages were retrieved, otherwise the missing posts are requested next time
+    if complete:
+        new_state = {
+            "last_modified": max([x["modified"] for x in changed] + [state.get("last_modified", modified_after)]),
+            "covered_from": covered_from,
+            "synced_at": str(started),
+        }
+    else:
+        LOG.warning(f"Some posts of '{site}' couldn't be retrieved, index will be synced again.")
+    
+    try:
+        index.update(changed, tag_names, new_state)
+    except sqlite3.Error:
+        LOG.exception(f"Post index of '{site}' couldn't be updated.")
+        return index
+    
+    LOG.info(f"Post index of '{site}' synced: {len(changed)} posts updated in {time.time() - started:.2f} s.")
+    return index
+
+
+def remove_unpublished_posts(index: PostIndex, api_url: str, posts: List) -> List:
+    """
+    Drop indexed posts which were trashed or unpublished since they were indexed (sync only sees published posts)
+    Status is verified by one request per batch of IDs, posts are kept if it couldn't be verified
+    """
+    
+    post_ids = [x["id"] for x in posts]
+    published = set()
+    for i in range(0, len(post_ids), INCLUDE_BATCH_SIZE):
+        batch = post_ids[i:i + INCLUDE_BATCH_SIZE]
+        params = {
+            "include": ",".join(str(x) for x in batch),
+            "per_page": len(batch),
+            "status": "publish",
+            "_fields": "id",
+        }
+        result = fetch_json(f"{api_url}/posts", params=params)
+        if result is None:
+            LOG.warning(f"Status of the indexed posts {batch} couldn't be verified.")
+            published.update(batch)
+            continue
+        published.update(x["id"] for x in result)
+    
+    removed = [x for x in post_ids if x not in published]
+    if removed:
+        LOG.info(f"Posts {removed} are not published anymore, removing them from the index.")
+        try:
+            index.remove(removed)
+        except sqlite3.Error:
+            LOG.exception("Unpublished posts couldn't be removed from the index.")
+    return [x for x in posts if x["id"] in published]
+
+
+def get_indexed_posts_by_slugs(index: PostIndex, api_url: str, post_urls: List) -> List:
+    """Data of the predefined posts from the index, posts which are not indexed are requested from the api"""
+    
+    slugs = [urlparse(x).path.strip("/").split("/")[-1] for x in post_urls]
+    indexed = index.posts_by_slugs(slugs)
+    if indexed:
+        indexed = {x["slug"]: x for x in remove_unpublished_posts(index, api_url, list(indexed.values()))}
+    
+    missing = [url for slug, url in zip(slugs, post_urls) if slug not in indexed]
+    requested = {x["slug"]: x for x in get_posts_by_slugs(api_url, missing)} if missing else {}
+    
+    posts = []
+    for slug in slugs:
+        post = indexed.get(slug) or requested.get(slug)
+        if post is not None:
+            posts.append(post)
+    return posts
+
+
+def get_valid_indexed_posts(index: PostIndex, api_url: str, pre_posts_len: int, number_posts: int, posts_from: str) -> List:
+    """Same as get_valid_posts, but posts are selected and filtered from the index"""
+    
+    # Create list of tag names that should be excluded
+    exclude_tags = None
+    
+    from_date, to_date = posts_day(posts_from)
+    posts_list = index.posts_between(from_date.isoformat(), to_date.isoformat())
+    
+    if exclude_tags is not None:
         LOG.info(f"Filtering out posts with tags: {exclude_tags}")
-        if posts.has_wrong_tag(post["tags"], exclude_tags):
-            LOG.info(f"Post {post['link']} will be skipped.")
-            posts_list.remove(post)
+        posts = Posts(api_url)
+        tag_names = index.tag_names()
+        posts_list = [x for x in posts_list if not posts.has_wrong_tag(x["tags"], exclude_tags, tag_names)]
     
     # Return selected number of posts or all of them
-    if number_posts != 0:        
-        return posts_list[:number_posts - pre_posts_len]
-    else:
-        return posts_list
+    wanted = max(number_posts - pre_posts_len, 0) if number_posts != 0 else len(posts_list)
+    
+    # Only the selected posts are verified, unpublished ones are replaced by the next posts from the index
+    selected = []
+    while posts_list and len(selected) < wanted:
+        candidates = posts_list[:wanted - len(selected)]
+        posts_list = posts_list[len(candidates):]
+        selected.extend(remove_unpublished_posts(index, api_url, candidates))
+    return selected
+
 
 class PostData(BaseModel):
     """Basic data retrieved from wordpress used in image"""
@@ -131,21 +401,88 @@ class PostData(BaseModel):
     title: str
     link: str
     cover: str
+    post_id: Optional[int] = None
 
 
 def _get_post_cover(api_url: str) -> str:
     """Get link of the post cover image"""
     
-    response = requests.get(api_url)
-    if response.status_code == 200:
-        result = response.json()
+    result = fetch_json(api_url)
+    if result is not None:
         return result["link"]
     else:
-        LOG.warning(f"Cover image {api_url} cannot be retrieved:\n{response.text}")
+        LOG.warning(f"Cover image {api_url} cannot be retrieved.")
         # raise Exception(response.text, response.status_code)
         return None
 
 
+def _get_embedded_cover(post: Dict) -> Optional[str]:
+    """Get link of the cover image embedded in the post response"""
+    
+    try:
+        media = post["_embedded"]["wp:featuredmedia"][0]
+        return media["link"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def get_post_covers(api_url: str, media_ids: List) -> Dict:
+    """Get links of the cover images by their media IDs, one request per batch of IDs"""
+    
+    media_ids = list(dict.fromkeys(x for x in media_ids if x))
+    covers = {}
+    
+    for i in range(0, len(media_ids), INCLUDE_BATCH_SIZE):
+        batch = media_ids[i:i + INCLUDE_BATCH_SIZE]
+        params = {
+            "include": ",".join(str(x) for x in batch),
+            "per_page": len(batch),
+            "_fields": "id,link",
+        }
+        media = fetch_json(f"{api_url}/media", params=params)
+        if media is None:
+            LOG.warning(f"Cover images {batch} couldn't be retrieved.")
+            continue
+        covers.update({x["id"]: x["link"] for x in media})
+    
+    return covers
+
+
+def get_posts_by_slugs(api_url: str, post_urls: List) -> List:
+    """Retrieve data of all predefined posts, one request per batch of slugs
+    Posts are returned in the same order as the urls"""
+    
+    # slug in the api is the last part of the url path
+    slugs = [urlparse(x).path.strip("/").split("/")[-1] for x in post_urls]
+    unique_slugs = list(dict.fromkeys(slugs))
+    
+    LOG.info(f"Getting data for the posts {post_urls}")
+    # Response is not ordered by requested slugs
+    posts_by_slug = {}
+    for i in range(0, len(unique_slugs), INCLUDE_BATCH_SIZE):
+        batch = unique_slugs[i:i + INCLUDE_BATCH_SIZE]
+        params = {
+            "slug[]": batch,
+            "per_page": len(batch),
+            "_embed": "wp:featuredmedia",
+            "_fields": POST_FIELDS,
+        }
+        result = fetch_json(f"{api_url}/posts", params=params)
+        if result is None:
+            LOG.info(f"Posts data couldn't be retrieved: {batch}")
+            continue
+        posts_by_slug.update({post["slug"]: post for post in result})
+    
+    posts = []
+    for slug, post_url in zip(slugs, post_urls):
+        post = posts_by_slug.get(slug)
+        if post is None:
+            LOG.info(f"Post data couldn't be retrieved: '{post_url}'")
+            continue
+        posts.append(post)
+    return posts
+
+
 def get_single_post(api_url: str, post_url: str) -> Dict:
     """Retrieve data of single post defined by its url
     Used for predefined posts"""
@@ -155,21 +492,26 @@ def get_single_post(api_url: str, post_url: str) -> Dict:
     slug_api_url = os.path.join(api_url, f"posts?slug={slug}")
 
     LOG.info(f"Getting data for the post '{post_url}'")
-    response = requests.get(slug_api_url)
-    if response.status_code == 200:
-        return response.json()[0]
+    result = fetch_json(slug_api_url)
+    if result:
+        return result[0]
     else:
-        LOG.info(f"Post data couldn't be retrieved: {response.text}")
+        LOG.info(f"Post data couldn't be retrieved: '{post_url}'")
         return None
     
 
-def get_post_data(url: str, post: Dict) -> PostData:
+def get_post_data(url: str, post: Dict, covers: Dict = None) -> PostData:
     """Create PostData object from post data retrieved by api request"""
     
-    # Get link of the cover image by its media id
+    # Get link of the cover image embedded in the post or already retrieved,
+    # otherwise request it by its media id
     media_id = post["featured_media"]
-    media_api_url = f"{url}/media/{media_id}"
-    post_cover = _get_post_cover(media_api_url)
+    post_cover = _get_embedded_cover(post)
+    if post_cover is None and covers is not None:
+        post_cover = covers.get(media_id)
+    if post_cover is None:
+        media_api_url = f"{url}/media/{media_id}"
+        post_cover = _get_post_cover(media_api_url)
     
     # Unescape special characters which sometimes occurs in title
     if "&#" in post["title"]["rendered"]:
@@ -186,7 +528,8 @@ def get_post_data(url: str, post: Dict) -> PostData:
     return PostData(
         title = title,
         link = post["link"],
-        cover = post_cover
+        cover = post_cover,
+        post_id = post.get("id")
     ).model_dump()
 
 
@@ -197,21 +540,39 @@ def get_posts_metadata(site: str, links: List, number_posts: int, posts_from: st
     
     pre_posts = []
     
-    # If any post links were defined on web, get their data first
-    if links:
-        for link in links:
-            pre_posts.append(get_single_post(api_url, link))
-     
-    # Append data of remaining posts (either all posts or up to max number)
-    posts = pre_posts + get_valid_posts(api_url, len(pre_posts), number_posts, posts_from)
+    with timed("posts"):
+        index = sync_post_index(site, api_url) if FETCH_MODE == "indexed" else None
+        
+        # If any post links were defined on web, get their data first (all links at once)
+        if links and index is not None:
+            pre_posts = get_indexed_posts_by_slugs(index, api_url, links)
+        elif links and FETCH_MODE != "concurrent":
+            pre_posts = get_posts_by_slugs(api_url, links)
+        elif links:
+            single_posts = map_concurrently(lambda link: get_single_post(api_url, link), links)
+            pre_posts = [post for post in single_posts if post is not None]
+         
+        # Append data of remaining posts (either all posts or up to max number),
+        # posts older than the index are requested from the api
+        if index is not None and index.covers(posts_from):
+            posts = pre_posts + get_valid_indexed_posts(index, api_url, len(pre_posts), number_posts, posts_from)
+        else:
+            posts = pre_posts + get_valid_posts(api_url, len(pre_posts), number_posts, posts_from)
     if not posts:
         raise LookupError("No posts found by given criteria")
 
     posts_data = []
     
-    # Get needed data from posts request responses 
-    for post in posts:
-        post_data = get_post_data(api_url, post)
+    # Covers which were not embedded in the posts response are requested at once
+    covers = None
+    with timed("covers"):
+        if FETCH_MODE != "concurrent":
+            covers = get_post_covers(api_url, [x["featured_media"] for x in posts if _get_embedded_cover(x) is None])
+        
+        # Get needed data from posts request responses, cover images are requested in parallel
+        posts_results = map_concurrently(lambda post: get_post_data(api_url, post, covers), posts)
+    
+    for post_data in posts_results:
         if post_data:
             LOG.info(f"Created PostData object: {post_data}")
             posts_data.append(post_data)
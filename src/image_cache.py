@@ -0,0 +1,211 @@
+"""Cache of the downloaded images on disk (shared by workers) and of decoded backgrounds in memory"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Hashable, Optional
+
+from PIL import Image
+
+from .downloads import download
+from .file_paths import cache_folder
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Max size of all images stored on disk
+MAX_CACHE_BYTES = int(os.getenv("WPIG_IMAGE_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+# Stored image is revalidated by its ETag after this time (seconds)
+REVALIDATE_AFTER = int(os.getenv("WPIG_IMAGE_CACHE_REVALIDATE", str(24 * 3600)))
+# Max size (MB) of decoded and resized backgrounds kept in the memory of every worker
+BACKGROUNDS_MAX_MB = int(os.getenv("WPIG_BACKGROUNDS_MAX_MB", "128"))
+
+
+def images_folder() -> Path:
+    return cache_folder() / "images"
+
+
+def _cache_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def _read_meta(meta_path: Path) -> Optional[Dict]:
+    try:
+        with open(meta_path, "r") as meta_f:
+            return json.load(meta_f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    """Write file so other workers never see it partially written"""
+
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as tmp_f:
+            tmp_f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_cached_image(url: str) -> Optional[Path]:
+    """Get path to the stored image downloaded from url.
+    Image is downloaded if not stored yet, or if its ETag has changed"""
+
+    folder = images_folder()
+    os.makedirs(folder, exist_ok=True)
+
+    key = _cache_key(url)
+    data_path = folder / key
+    meta_path = folder / f"{key}.json"
+
+    meta = _read_meta(meta_path) if data_path.exists() else None
+    if meta is not None and time.time() - meta["validated_at"] < REVALIDATE_AFTER:
+        LOG.info(f"Using cached image for {url}")
+        # Access time is used for eviction
+        os.utime(meta_path)
+        return data_path
+
+    headers = {}
+    if meta is not None and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+
+    response = download(url, headers)
+    if response is None:
+        # Stale image is still better than nothing
+        return data_path if meta is not None else None
+
+    if response.status_code == 304 and meta is not None:
+        LOG.info(f"Cached image for {url} is still valid.")
+        meta["validated_at"] = time.time()
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+        return data_path
+
+    if response.status_code not in [200, 201]:
+        LOG.error(f"Image could not be retrieved from the url {url}")
+        return None
+
+    try:
+        _write_atomic(data_path, response.content)
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "size": len(response.content),
+            "validated_at": time.time(),
+        }
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+    except OSError:
+        LOG.exception(f"Image from {url} could not be stored in the cache.")
+        return None
+
+    LOG.info(f"Image from {url} succefully retrieved and cached.")
+    evict_images()
+    return data_path
+
+
+def evict_images(max_bytes: int = MAX_CACHE_BYTES) -> None:
+    """Remove least recently used images until the cache fits into the size limit"""
+
+    folder = images_folder()
+    entries = []
+    total_size = 0
+    for meta_path in folder.glob("*.json"):
+        data_path = meta_path.with_suffix("")
+        try:
+            size = data_path.stat().st_size
+            accessed = meta_path.stat().st_mtime
+        except OSError:
+            continue
+        entries.append((accessed, data_path, meta_path, size))
+        total_size += size
+
+    if total_size <= max_bytes:
+        return None
+
+    entries.sort(key=lambda x: x[0])
+    for _, data_path, meta_path, size in entries:
+        if total_size <= max_bytes:
+            break
+        LOG.info(f"Evicting cached image '{data_path.name}'")
+        for path in [meta_path, data_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total_size -= size
+
+
+class LRUCache:
+    """Thread safe in-memory least recently used cache"""
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+def image_bytes(image: Image.Image) -> int:
+    """Memory taken by the decoded image"""
+
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageLRUCache(LRUCache):
+    """Thread safe in-memory least recently used cache of images bounded by their size"""
+
+    def __init__(self, max_mb: int):
+        super().__init__(max_items=0)
+        self.max_bytes = max_mb * 1024 * 1024
+        self._bytes = 0
+
+    def put(self, key: Hashable, value: Image.Image) -> None:
+        size = image_bytes(value)
+        with self._lock:
+            if key in self._items:
+                self._bytes -= image_bytes(self._items.pop(key))
+            if size > self.max_bytes:
+                # Image would evict everything else
+                return None
+            self._items[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= image_bytes(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+
+# Decoded backgrounds already resized to the size from template
+BACKGROUNDS = ImageLRUCache(BACKGROUNDS_MAX_MB)
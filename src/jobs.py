@@ -0,0 +1,148 @@
+"""Background jobs (stories creation, sending emails) running outside of the request.
+State of every job is stored in a file, so its status can be requested from any worker"""
+
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from .file_paths import jobs_folder
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Number of jobs running at the same time in one worker, every job runs in its own OS thread
+# (rendering without the render pool holds the GIL, so set WPIG_RENDER_WORKERS for busy servers)
+JOB_WORKERS = int(os.getenv("WPIG_JOB_WORKERS", "2"))
+# Finished jobs are removed after this time (seconds)
+JOB_TTL = int(os.getenv("WPIG_JOB_TTL", str(24 * 3600)))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _is_gevent_patched() -> bool:
+    """Check if threads were replaced by greenlets (gevent worker of gunicorn)"""
+
+    if "gevent.monkey" not in sys.modules:
+        return False
+    return sys.modules["gevent.monkey"].is_module_patched("threading")
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Jobs run in native threads even in the gevent worker,
+    so rendering in a job doesn't block all other requests of the worker"""
+
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            if _is_gevent_patched():
+                from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+
+                _executor = NativeThreadPoolExecutor(max_workers=JOB_WORKERS)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="wp_job")
+    return _executor
+
+
+def _job_path(job_id: str) -> Path:
+    return jobs_folder() / f"{job_id}.json"
+
+
+def _save_job(job: Dict) -> None:
+    """Write state of the job, so other workers never read it partially written"""
+
+    folder = jobs_folder()
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_")
+    with os.fdopen(fd, "w") as tmp_f:
+        json.dump(job, tmp_f)
+    os.replace(tmp_path, _job_path(job["id"]))
+
+
+def get_job(job_id: str) -> Optional[Dict]:
+    """State of the job, None if job doesn't exist"""
+
+    if not _JOB_ID.match(job_id):
+        return None
+
+    try:
+        with open(_job_path(job_id), "r") as job_f:
+            return json.load(job_f)
+    except (OSError, ValueError):
+        return None
+
+
+def _update_job(job: Dict, **values) -> None:
+    job.update(values, updated_at=time.time())
+    _save_job(job)
+
+
+def _run_job(job: Dict, func: Callable, args: tuple) -> None:
+    LOG.info(f"Job {job['id']} ({job['kind']}) started.")
+    _update_job(job, status=RUNNING)
+    try:
+        result = func(*args)
+    except Exception as e:
+        LOG.exception(f"Job {job['id']} ({job['kind']}) failed.")
+        _update_job(job, status=FAILED, error=str(e))
+        return None
+
+    LOG.info(f"Job {job['id']} ({job['kind']}) finished.")
+    _update_job(job, status=DONE, result=result)
+
+
+def submit_job(kind: str, func: Callable, *args: Any, site: Optional[str] = None) -> str:
+    """Run function in the background, returns ID of the job immediately.
+    Result of the function has to be json serializable"""
+
+    remove_old_jobs()
+
+    now = time.time()
+    job = {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "site": site,
+        "status": QUEUED,
+        "created_at": now,
+        "updated_at": now,
+        "result": None,
+        "error": None,
+    }
+    _save_job(job)
+    _get_executor().submit(_run_job, job, func, args)
+
+    LOG.info(f"Job {job['id']} ({kind}) submitted.")
+    return job["id"]
+
+
+def remove_old_jobs() -> None:
+    """Remove files of the jobs which were not updated for a long time"""
+
+    folder = jobs_folder()
+    if not folder.exists():
+        return None
+
+    for job_path in folder.glob("*.json"):
+        try:
+            if time.time() - job_path.stat().st_mtime > JOB_TTL:
+                os.remove(job_path)
+        except OSError:
+            continue
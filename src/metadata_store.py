@@ -0,0 +1,213 @@
+"""Server-side store of the created stories metadata, session refers to it only by the workspace ID"""
+
+import json
+import logging
+import os
+import sqlite3
+import sys
+from contextlib import closing
+from typing import Dict, List, Optional
+
+from .file_paths import workspaces_folder
+from .image_cache import LRUCache
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Number of stories sets (workspace and site) kept in the memory of every worker
+METADATA_LRU_SIZE = int(os.getenv("WPIG_METADATA_LRU_SIZE", "64"))
+
+# Stories created without workspace (outside of the web session)
+NO_WORKSPACE = ""
+
+
+class MetadataStore:
+    """SQLite store of the stories metadata, one row per story.
+    Number and filename of the story are columns, so stories can be renumbered without rewriting their data"""
+
+    def __init__(self, path: str, lru_size: int = METADATA_LRU_SIZE):
+        self.path = path
+        # Version of the stories set is increased on every change,
+        # so the memory cache of one worker is not used after other worker changed the stories
+        self._memory = LRUCache(lru_size)
+        self._create_tables()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _create_tables(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS stories (
+                    workspace TEXT NOT NULL,
+                    site TEXT NOT NULL,
+                    number INTEGER NOT NULL,
+                    extension TEXT NOT NULL,
+                    data TEXT NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS stories_set ON stories (workspace, site, number)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS versions (
+                    workspace TEXT NOT NULL,
+                    site TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    PRIMARY KEY (workspace, site)
+                )"""
+            )
+
+    def _bump_version(self, conn: sqlite3.Connection, workspace: str, site: str) -> None:
+        conn.execute(
+            """INSERT INTO versions VALUES (?, ?, 1)
+            ON CONFLICT (workspace, site) DO UPDATE SET version = version + 1""",
+            (workspace, site),
+        )
+
+    @staticmethod
+    def _row(story: Dict) -> tuple:
+        data = {k: v for k, v in story.items() if k not in ["number", "filename"]}
+        extension = os.path.splitext(story.get("filename", ".png"))[1]
+        return story["number"], extension, json.dumps(data)
+
+    def get(self, workspace: str, site: str) -> List[Dict]:
+        """Metadata of all stories ordered by their number"""
+
+        key = (workspace, site)
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT version FROM versions WHERE workspace = ? AND site = ?", key).fetchone()
+            if row is None:
+                return []
+
+            version = row[0]
+            cached = self._memory.get(key)
+            if cached is not None and cached[0] == version:
+                return json.loads(cached[1])
+
+            # Stories are read after the version, so they are never older than the version they are cached with
+            rows = conn.execute(
+                "SELECT number, extension, data FROM stories WHERE workspace = ? AND site = ? ORDER BY number", key
+            ).fetchall()
+
+        stories = [{"number": number, "filename": f"{number}{extension}", **json.loads(data)} for number, extension, data in rows]
+        # Serialized, so returned lists can be changed by the caller
+        self._memory.put(key, (version, json.dumps(stories)))
+        return stories
+
+    def replace(self, workspace: str, site: str, stories: List[Dict]) -> None:
+        """Replace all stories of the site in the workspace"""
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM stories WHERE workspace = ? AND site = ?", (workspace, site))
+            conn.executemany(
+                "INSERT INTO stories VALUES (?, ?, ?, ?, ?)",
+                [(workspace, site, *self._row(x)) for x in stories],
+            )
+            self._bump_version(conn, workspace, site)
+
+    def put_story(self, workspace: str, site: str, story: Dict) -> None:
+        """Add or replace single story"""
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "DELETE FROM stories WHERE workspace = ? AND site = ? AND number = ?", (workspace, site, story["number"])
+            )
+            conn.execute("INSERT INTO stories VALUES (?, ?, ?, ?, ?)", (workspace, site, *self._row(story)))
+            self._bump_version(conn, workspace, site)
+
+    def delete_story(self, workspace: str, site: str, number: int) -> None:
+        """Remove story and shift numbers of the following ones, so they stay in ascending order"""
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM stories WHERE workspace = ? AND site = ? AND number = ?", (workspace, site, number))
+            conn.execute(
+                "UPDATE stories SET number = number - 1 WHERE workspace = ? AND site = ? AND number > ?",
+                (workspace, site, number),
+            )
+            self._bump_version(conn, workspace, site)
+
+    def remove_workspace(self, workspace: str) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM stories WHERE workspace = ?", (workspace,))
+            conn.execute("DELETE FROM versions WHERE workspace = ?", (workspace,))
+
+
+_store = None
+
+
+def get_metadata_store() -> Optional[MetadataStore]:
+    """Store instance of the worker, None if it's not available"""
+
+    global _store
+
+    if _store is None:
+        try:
+            _store = MetadataStore(str(workspaces_folder() / "metadata.sqlite"))
+        except (sqlite3.Error, OSError):
+            LOG.exception("Metadata store couldn't be opened.")
+            return None
+    return _store
+
+
+def load_stories_metadata(site: str, workspace: str = None) -> List:
+    """Metadata of the created stories, empty list if there are none"""
+
+    store = get_metadata_store()
+    if store is None:
+        return []
+    try:
+        return store.get(workspace or NO_WORKSPACE, site)
+    except sqlite3.Error:
+        LOG.exception(f"Stories metadata of '{site}' couldn't be loaded.")
+        return []
+
+
+def save_stories_metadata(site: str, metadata: List, workspace: str = None) -> None:
+    """Store metadata of all created stories, replaces the previous ones"""
+
+    store = get_metadata_store()
+    if store is None:
+        return None
+    try:
+        store.replace(workspace or NO_WORKSPACE, site, metadata)
+    except sqlite3.Error:
+        LOG.exception(f"Stories metadata of '{site}' couldn't be saved.")
+
+
+def save_story_metadata(site: str, story: Dict, workspace: str = None) -> None:
+    """Store metadata of single created story"""
+
+    store = get_metadata_store()
+    if store is None:
+        return None
+    try:
+        store.put_story(workspace or NO_WORKSPACE, site, story)
+    except sqlite3.Error:
+        LOG.exception(f"Metadata of the story {story['number']} of '{site}' couldn't be saved.")
+
+
+def delete_story_metadata(site: str, number: int, workspace: str = None) -> bool:
+    """Remove metadata of the deleted story, returns False if it couldn't be removed"""
+
+    store = get_metadata_store()
+    if store is None:
+        return False
+    try:
+        store.delete_story(workspace or NO_WORKSPACE, site, number)
+    except sqlite3.Error:
+        LOG.exception(f"Metadata of the story {number} of '{site}' couldn't be removed.")
+        return False
+    return True
+
+
+def remove_workspace_metadata(workspace: str) -> None:
+    store = get_metadata_store()
+    if store is None:
+        return None
+    try:
+        store.remove_workspace(workspace)
+    except sqlite3.Error:
+        LOG.exception(f"Stories metadata of the workspace '{workspace}' couldn't be removed.")
@@ -0,0 +1,82 @@
+"""Whole stories generation (posts data -> image elements -> images) running on the server"""
+
+import logging
+import sys
+from typing import Dict, Iterator, List, Optional
+
+from .create_stories import Template, PostData, ImageElements
+from .create_stories import get_story_template, get_elements, iter_create_stories, create_stories, set_preview
+from .get_posts_metadata import get_posts_metadata
+from .metadata_store import save_stories_metadata, save_story_metadata
+from .render_state import load_manifest
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+def generate_stories(site: str, links: List, number_posts: int, posts_from: str, workspace: str = None, preview: bool = False) -> Iterator[Dict]:
+    """Get posts data, create elements and images of all stories.
+    Yields progress events, every created story is yielded as soon as its image is created"""
+
+    try:
+        posts_data = get_posts_metadata(site, links, number_posts, posts_from)
+    except (ValueError, LookupError) as err:
+        yield {"event": "error", "error": str(err)}
+        return
+
+    yield {"event": "posts", "count": len(posts_data)}
+
+    template_data = get_story_template(site)
+    if not template_data:
+        LOG.error("Error while getting template.")
+        yield {"event": "error", "error": "Couldn't load template."}
+        return
+
+    # Objects are passed directly, no need to serialize them between the steps
+    posts = [PostData.model_validate(x) for x in posts_data]
+    template = Template.model_validate(template_data)
+    posts_elements = [ImageElements.model_validate(x) for x in get_elements(posts, template)]
+    set_preview(posts_elements, preview)
+
+    stories = iter_create_stories(site, posts_elements, workspace=workspace)
+    if stories is None:
+        LOG.error("Stories creation failed.")
+        yield {"event": "error", "error": "Stories creation failed."}
+        return
+
+    # Metadata of the previous stories are removed, every new story is stored as soon as it's created
+    save_stories_metadata(site, [], workspace)
+    metadata = []
+    for story in stories:
+        metadata.append(story)
+        save_story_metadata(site, story, workspace)
+        yield {"event": "story", "story": story, "created": len(metadata), "total": len(posts_elements)}
+
+    LOG.info(f"Successfully created {len(metadata)} images.")
+    yield {"event": "done", "count": len(metadata)}
+
+
+def has_previews(site: str, workspace: str = None) -> bool:
+    """Check if any story was created only as preview"""
+
+    return any(x["elements"].get("preview_scale") for x in load_manifest(site, workspace).values())
+
+
+def render_full_resolution(site: str, workspace: str = None) -> Optional[List]:
+    """Render again in the full resolution all stories which were created only as previews.
+    Returns metadata of the stories, or None if nothing had to be rendered"""
+
+    manifest = load_manifest(site, workspace)
+    posts_elements = [ImageElements.model_validate(manifest[x]["elements"]) for x in sorted(manifest)]
+    if not any(x.preview_scale for x in posts_elements):
+        return None
+
+    LOG.info(f"Rendering {len(posts_elements)} previews in the full resolution...")
+    set_preview(posts_elements, False)
+    # Stories already rendered in the full resolution are skipped
+    metadata = create_stories(site, posts_elements, incremental=True, workspace=workspace)
+    if metadata is None:
+        raise RuntimeError("Stories couldn't be rendered in the full resolution.")
+
+    save_stories_metadata(site, metadata, workspace)
+    return metadata
@@ -0,0 +1,162 @@
+"""Local index of the posts of every site, kept in sync with wordpress by the posts modified since the last sync"""
+
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import closing
+from typing import Dict, List, Optional
+
+from .file_paths import cache_folder
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Number of days of posts retrieved by the first sync of the site
+POST_INDEX_DAYS = int(os.getenv("WPIG_POST_INDEX_DAYS", "7"))
+# Index older than this (seconds) is synced before it's used
+POST_INDEX_SYNC_INTERVAL = int(os.getenv("WPIG_POST_INDEX_SYNC_INTERVAL", "300"))
+
+
+class PostIndex:
+    """SQLite index of the posts of one site with everything needed to create stories,
+    so listing posts by date, looking up slugs and excluding tags needs no api request"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._create_tables()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _create_tables(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS posts (
+                    id INTEGER PRIMARY KEY,
+                    slug TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    link TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    modified TEXT NOT NULL,
+                    featured_media INTEGER,
+                    cover TEXT,
+                    tags TEXT NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS posts_date ON posts (date)")
+            conn.execute("CREATE INDEX IF NOT EXISTS posts_slug ON posts (slug)")
+            conn.execute("CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+            # last_modified - newest modification date of the indexed posts (site time)
+            # covered_from - date since which all posts are indexed, synced_at - unix time of the last sync
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def state(self) -> Dict[str, str]:
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT key, value FROM state").fetchall())
+
+    def is_stale(self, interval: int = POST_INDEX_SYNC_INTERVAL) -> bool:
+        synced_at = self.state().get("synced_at")
+        return synced_at is None or time.time() - float(synced_at) > interval
+
+    def covers(self, date: str) -> bool:
+        """Check if all posts published since the date (YYYY-MM-DD) are indexed"""
+
+        covered_from = self.state().get("covered_from")
+        return covered_from is not None and date >= covered_from
+
+    def update(self, posts: List[Dict], tag_names: Dict[int, str], state: Dict[str, str]) -> None:
+        """Insert or replace posts (in the api format with resolved cover) and save the sync state"""
+
+        rows = [
+            (
+                post["id"], post["slug"], post["title"]["rendered"], post["link"], post["date"], post["modified"],
+                post.get("featured_media"), post.get("cover"), json.dumps(post.get("tags", [])),
+            )
+            for post in posts
+        ]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.executemany("INSERT OR REPLACE INTO tags VALUES (?, ?)", list(tag_names.items()))
+            conn.executemany("INSERT OR REPLACE INTO state VALUES (?, ?)", list(state.items()))
+
+    def remove(self, post_ids: List[int]) -> None:
+        """Drop posts which are not published anymore"""
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("DELETE FROM posts WHERE id = ?", [(x,) for x in post_ids])
+
+    def missing_tags(self, tag_ids: List[int]) -> List[int]:
+        """IDs of the tags whose names are not indexed yet"""
+
+        tag_ids = list(dict.fromkeys(tag_ids))
+        with closing(self._connect()) as conn:
+            known = {row[0] for row in conn.execute("SELECT id FROM tags")}
+        return [x for x in tag_ids if x not in known]
+
+    def tag_names(self) -> Dict[int, str]:
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT id, name FROM tags").fetchall())
+
+    @staticmethod
+    def _post(row: tuple) -> Dict:
+        """Post in the same format as returned by the api"""
+
+        post_id, slug, title, link, date, modified, featured_media, cover, tags = row
+        post = {
+            "id": post_id,
+            "slug": slug,
+            "title": {"rendered": title},
+            "link": link,
+            "date": date,
+            "modified": modified,
+            "featured_media": featured_media,
+            "tags": json.loads(tags),
+        }
+        if cover:
+            post["_embedded"] = {"wp:featuredmedia": [{"link": cover}]}
+        return post
+
+    def posts_between(self, after: str, before: str) -> List[Dict]:
+        """Posts published within the dates (ISO format), newest first as in the api"""
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM posts WHERE date >= ? AND date < ? ORDER BY date DESC, id DESC", (after, before)
+            ).fetchall()
+        return [self._post(x) for x in rows]
+
+    def posts_by_slugs(self, slugs: List[str]) -> Dict[str, Dict]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT * FROM posts WHERE slug IN ({','.join('?' * len(slugs))})", slugs
+            ).fetchall()
+        return {row[1]: self._post(row) for row in rows}
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def post_index_path(site: str) -> str:
+    return str(cache_folder() / "posts" / f"{site}.sqlite")
+
+
+def get_post_index(site: str) -> Optional[PostIndex]:
+    """Index of the site, None if it's not available"""
+
+    with _indexes_lock:
+        if site not in _indexes:
+            try:
+                _indexes[site] = PostIndex(post_index_path(site))
+            except (sqlite3.Error, OSError):
+                LOG.exception(f"Post index of '{site}' couldn't be opened.")
+                return None
+        return _indexes[site]
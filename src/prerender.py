@@ -0,0 +1,180 @@
+"""Rendering of the stories of the newly published posts in advance, so editors only get the finished images.
+
+Runs periodically in the background process of the app (one per server) if WPIG_PRERENDER_INTERVAL is set,
+or once per run by the CLI:
+
+    python -m src.cli --prerender
+"""
+
+import atexit
+import fcntl
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+import time
+from datetime import date, timedelta
+from typing import Dict, List
+
+from .create_stories import Template, PostData, ImageElements
+from .create_stories import get_story_template, get_elements, iter_render_stories
+from .encoders import story_filename
+from .file_paths import cache_folder, data_folder, stories_folder, workspaces_folder
+from .get_posts_metadata import get_posts_metadata
+from .prerender_cache import input_key, is_prerendered, remove_stale_prerendered, store_prerendered
+from .render_plan import template_version
+from .workspaces import new_workspace
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Seconds between the pre-rendering rounds in the app, 0 disables it
+PRERENDER_INTERVAL = int(os.getenv("WPIG_PRERENDER_INTERVAL", "0"))
+# Posts of this number of last days (including today) are pre-rendered
+PRERENDER_DAYS = int(os.getenv("WPIG_PRERENDER_DAYS", "2"))
+# Max number of the latest posts of the site and day
+PRERENDER_POSTS = int(os.getenv("WPIG_PRERENDER_POSTS", "20"))
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def prerender_site(site: str, days: int = PRERENDER_DAYS, number_posts: int = PRERENDER_POSTS) -> Dict:
+    """Render default stories of the latest posts which were not rendered by the current template yet.
+    Covers are downloaded and decoded to the image cache on the way. Returns summary of the round"""
+
+    summary = {"site": site, "posts": 0, "rendered": 0, "failed": 0}
+    version = template_version(site)
+    template_data = get_story_template(site)
+    if version is None or not template_data:
+        LOG.error(f"Template of '{site}' couldn't be loaded, nothing is pre-rendered.")
+        return summary
+
+    posts = {}
+    for day in range(days):
+        posts_from = (date.today() - timedelta(days=day)).isoformat()
+        try:
+            posts_data = get_posts_metadata(site, [], number_posts, posts_from)
+        except (ValueError, LookupError):
+            LOG.info(f"No posts of '{site}' from {posts_from} to pre-render.")
+            continue
+        for post_data in posts_data:
+            post = PostData.model_validate(post_data)
+            if post.post_id is not None:
+                posts.setdefault(post.post_id, post)
+
+    summary["posts"] = len(posts)
+    new_posts = [x for x in posts.values() if not is_prerendered(site, x.post_id, version)]
+    if new_posts:
+        LOG.info(f"Pre-rendering {len(new_posts)} stories of '{site}'...")
+        template = Template.model_validate(template_data)
+        posts_elements = [ImageElements.model_validate(x) for x in get_elements(new_posts, template)]
+        # Elements are changed while rendering, stories are matched by the requested ones
+        keys = [input_key(x) for x in posts_elements]
+
+        workspace = new_workspace()
+        try:
+            for key, (is_ok, elems, _) in zip(keys, iter_render_stories(site, posts_elements, workspace=workspace)):
+                if not is_ok:
+                    summary["failed"] += 1
+                    continue
+                image_path = stories_folder(site, workspace) / story_filename(elems.number, elems.output)
+                store_prerendered(site, key, elems, image_path, version)
+                summary["rendered"] += 1
+        finally:
+            shutil.rmtree(workspaces_folder() / workspace, ignore_errors=True)
+
+    remove_stale_prerendered(site, version)
+    LOG.info(f"Pre-rendering of '{site}' done: {summary}")
+    return summary
+
+
+def prerender_all(sites: List[str] = None) -> List[Dict]:
+    """Pre-render stories of all sites with template (one site after another).
+    Skipped if other process is already pre-rendering"""
+
+    if sites is None:
+        sites = sorted(x.parent.name for x in data_folder().glob("*/template.yaml"))
+
+    lock_path = cache_folder() / "prerendered" / ".lock"
+    os.makedirs(lock_path.parent, exist_ok=True)
+    with open(lock_path, "w") as lock_f:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            LOG.info("Stories are already pre-rendered by other process.")
+            return []
+
+        summaries = []
+        for site in sites:
+            try:
+                summaries.append(prerender_site(site))
+            except Exception as e:
+                LOG.exception(f"Pre-rendering of '{site}' failed.")
+                summaries.append({"site": site, "error": str(e)})
+        return summaries
+
+
+def _run_rounds(interval: int, parent_pid: int) -> None:
+    """Pre-render periodically until the worker which started the process exits"""
+
+    while os.getppid() == parent_pid:
+        try:
+            prerender_all()
+        except Exception:
+            LOG.exception("Pre-rendering round failed.")
+        time.sleep(interval)
+
+
+def _stop_process(process: multiprocessing.Process) -> None:
+    if process.is_alive():
+        process.terminate()
+        process.join(5)
+
+
+def _supervise(interval: int) -> None:
+    """Keep the pre-rendering process running in the worker holding the scheduler lock.
+    Other workers try to get the lock later, so one of them takes over when the worker exits"""
+
+    lock_path = cache_folder() / "prerendered" / ".scheduler.lock"
+    os.makedirs(lock_path.parent, exist_ok=True)
+    lock_f = open(lock_path, "w")
+    process = None
+    while True:
+        if process is None:
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                time.sleep(interval)
+                continue
+
+        if process is None or not process.is_alive():
+            LOG.info(f"Pre-rendering stories every {interval} s in the background process.")
+            # spawn - forking of the (gevent) worker with its threads and sockets is not safe,
+            # not daemonic, so it can start its own render pool
+            process = multiprocessing.get_context("spawn").Process(
+                target=_run_rounds, args=(interval, os.getpid()), name="prerender",
+                )
+            process.start()
+            atexit.register(_stop_process, process)
+        time.sleep(interval)
+
+
+def start_prerender_scheduler(interval: int = PRERENDER_INTERVAL) -> bool:
+    """Start periodic pre-rendering, once per process. Rendering runs in the separate process
+    started by only one worker of the server, so it never blocks requests or renders the same posts twice.
+    Returns False if it's disabled"""
+
+    global _scheduler
+
+    if interval <= 0:
+        return False
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = threading.Thread(target=_supervise, args=(interval,), name="prerender", daemon=True)
+            _scheduler.start()
+    return True
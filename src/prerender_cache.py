@@ -0,0 +1,121 @@
+"""Stories rendered in advance for the newly published posts, keyed by post ID and template version"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from .canvas import ImageElements
+from .encoders import file_extension, story_filename
+from .file_paths import cache_folder
+from .render_cache import place_file
+from .render_plan import template_version
+from .render_state import render_key
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Pre-rendered stories older than this (days) are removed
+PRERENDER_MAX_AGE = float(os.getenv("WPIG_PRERENDER_MAX_AGE", "3"))
+
+
+def prerendered_folder(site: str) -> Path:
+    return cache_folder() / "prerendered" / site
+
+
+def input_key(elements: ImageElements) -> str:
+    """Hash of the elements requested to be rendered, full resolution story is used for the preview as well"""
+
+    return render_key(elements.model_copy(update={"preview_scale": None}))
+
+
+def _entry_path(site: str, post_id: int, version: str) -> Path:
+    return prerendered_folder(site) / f"{post_id}-{version}.json"
+
+
+def is_prerendered(site: str, post_id: int, version: str) -> bool:
+    return _entry_path(site, post_id, version).exists()
+
+
+def store_prerendered(site: str, key: str, elements: ImageElements, image_path: Path, version: str) -> None:
+    """Keep rendered story of the post with its elements (as they are after rendering)"""
+
+    folder = prerendered_folder(site)
+    extension = file_extension(elements.output)
+    entry = {"input_key": key, "extension": extension, "elements": elements.model_dump()}
+    try:
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_", suffix=extension)
+        with os.fdopen(fd, "wb") as tmp_f, open(image_path, "rb") as image_f:
+            shutil.copyfileobj(image_f, tmp_f)
+        os.replace(tmp_path, folder / f"{elements.post_id}-{version}{extension}")
+        # Entry is written last, so it never refers to missing image
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_", suffix=".json")
+        with os.fdopen(fd, "w") as entry_f:
+            json.dump(entry, entry_f)
+        os.replace(tmp_path, _entry_path(site, elements.post_id, version))
+    except OSError:
+        LOG.exception(f"Pre-rendered story of the post {elements.post_id} couldn't be stored.")
+
+
+def take_prerendered(site: str, posts_elements: List[ImageElements], output_folder: Path) -> Dict[int, ImageElements]:
+    """Copy pre-rendered stories of the posts which were requested exactly as they were rendered into the output folder.
+    Returns elements of the copied stories by their number"""
+
+    candidates = [x for x in posts_elements if x.post_id is not None]
+    if not candidates:
+        return {}
+
+    version = template_version(site)
+    if version is None:
+        return {}
+
+    taken = {}
+    for elements in candidates:
+        try:
+            with open(_entry_path(site, elements.post_id, version)) as entry_f:
+                entry = json.load(entry_f)
+        except (OSError, ValueError):
+            continue
+        if entry["input_key"] != input_key(elements):
+            continue
+
+        rendered = ImageElements.model_validate(entry["elements"])
+        rendered.number = elements.number
+        rendered.post_url = elements.post_url
+        rendered.preview_scale = None
+        try:
+            os.makedirs(output_folder, exist_ok=True)
+            place_file(
+                prerendered_folder(site) / f"{elements.post_id}-{version}{entry['extension']}",
+                output_folder / story_filename(rendered.number, rendered.output),
+            )
+        except OSError:
+            LOG.exception(f"Pre-rendered story of the post {elements.post_id} couldn't be copied.")
+            continue
+        taken[elements.number] = rendered
+
+    if taken:
+        LOG.info(f"Using {len(taken)} pre-rendered stories of '{site}'.")
+    return taken
+
+
+def remove_stale_prerendered(site: str, version: str, max_age: float = PRERENDER_MAX_AGE) -> None:
+    """Remove stories rendered by the other version of the template or too long ago"""
+
+    now = time.time()
+    for path in prerendered_folder(site).glob("*"):
+        try:
+            age = now - path.stat().st_mtime
+            # Temporary files are left only by interrupted writes
+            is_stale = age > 3600 if path.name.startswith(".tmp_") else f"-{version}." not in path.name
+            if is_stale or age > max_age * 24 * 3600:
+                os.remove(path)
+        except OSError:
+            continue
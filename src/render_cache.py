@@ -0,0 +1,130 @@
+"""Cache of the rendered stories keyed by hash of their elements and of the files they use"""
+
+import errno
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+from .canvas import ImageElements
+from .encoders import file_extension
+from .file_paths import cache_folder
+from .render_state import render_key
+from .timings import RENDER_CACHE_REQUESTS
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Max size of the rendered stories stored in the cache, 0 disables the cache
+RENDER_CACHE_MAX_BYTES = int(os.getenv("WPIG_RENDER_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+
+
+def renders_folder() -> Path:
+    return cache_folder() / "renders"
+
+
+def render_cache_key(elements: ImageElements) -> str:
+    """Hash of everything visible in the story and of the versions of its files"""
+
+    return render_key(elements)
+
+
+def place_file(source: Path, target: Path) -> None:
+    """Put the file to the target path as a hard link, or as a copy if it's on other file system.
+    Target is replaced atomically, so the file it was linked to before is never overwritten"""
+
+    # Unique name, link of the other thread must never be opened for writing
+    tmp_path = target.parent / f".tmp_{uuid.uuid4().hex}_{target.name}"
+    try:
+        try:
+            os.link(source, tmp_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+    finally:
+        # Replace does nothing if target is already link of the same file
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_rendered(key: str, elements: ImageElements, target: Path) -> bool:
+    """Place the cached story with the same elements (key) to the target path.
+    Values computed during rendering are set to the elements. Returns False if it's not cached"""
+
+    if RENDER_CACHE_MAX_BYTES <= 0:
+        return False
+
+    image_path = renders_folder() / f"{key}{file_extension(elements.output)}"
+    try:
+        with open(renders_folder() / f"{key}.json") as entry_f:
+            background = json.load(entry_f)["background"]
+        os.makedirs(target.parent, exist_ok=True)
+        place_file(image_path, target)
+        # Recently used stories are evicted last
+        os.utime(image_path)
+    except (OSError, ValueError, KeyError):
+        RENDER_CACHE_REQUESTS.inc("miss")
+        return False
+
+    elements.background.position = background["position"]
+    elements.background.min_position_x = background["min_position_x"]
+    elements.background.max_position_x = background["max_position_x"]
+    RENDER_CACHE_REQUESTS.inc("hit")
+    LOG.info(f"Story {elements.number} taken from the render cache.")
+    return True
+
+
+def put_rendered(key: str, elements: ImageElements, image_path: Path) -> None:
+    """Store rendered story, key is computed from the elements before rendering"""
+
+    if RENDER_CACHE_MAX_BYTES <= 0:
+        return None
+
+    folder = renders_folder()
+    target = folder / f"{key}{file_extension(elements.output)}"
+    entry = {"background": elements.background.model_dump(include={"position", "min_position_x", "max_position_x"})}
+    try:
+        os.makedirs(folder, exist_ok=True)
+        place_file(image_path, target)
+        # Entry is written last, so it never refers to missing image
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_", suffix=".json")
+        with os.fdopen(fd, "w") as entry_f:
+            json.dump(entry, entry_f)
+        os.replace(tmp_path, folder / f"{key}.json")
+    except OSError:
+        LOG.exception(f"Story {elements.number} couldn't be stored in the render cache.")
+        return None
+
+    _evict_renders()
+
+
+def _evict_renders() -> None:
+    """Remove least recently used stories until they fit into the size limit"""
+
+    files = []
+    for path in renders_folder().glob("*"):
+        if path.suffix == ".json" or path.name.startswith("."):
+            continue
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(x[1] for x in files)
+    for _, size, path in sorted(files):
+        if total_size <= RENDER_CACHE_MAX_BYTES:
+            break
+        for stale in [path, path.with_suffix(".json")]:
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+        total_size -= size
@@ -0,0 +1,137 @@
+"""Static resources of the template (fonts, overlay images, shapes) loaded once per worker"""
+
+import hashlib
+import json
+import logging
+import sys
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from envyaml import EnvYAML
+from PIL import Image, ImageFont
+
+from .blending import PreparedOverlay, prepare_overlay
+from .canvas import draw_shape, open_image
+from .file_paths import template_path
+from .render_state import file_stamp
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+
+def _shape_key(details: Dict) -> str:
+    """Shapes differing only in position are drawn the same way"""
+
+    return json.dumps({k: v for k, v in details.items() if k != "position"}, sort_keys=True)
+
+
+class RenderPlan:
+    """Compiled template of the site, holds all resources which are the same for every story"""
+
+    def __init__(self, site: str):
+        self.site = site
+        self.fonts = {}
+        self.overlays = {}
+        self.prepared = {}
+        self.shapes = {}
+        self.asset_paths = [str(template_path(site))]
+        self.fingerprint = None
+
+    def compile(self) -> None:
+        """Load all resources referenced in the template"""
+
+        template = EnvYAML(template_path(self.site))
+        elements = template["elements"]
+
+        for text_conf in elements.get("texts") or []:
+            self.font(text_conf["font"], text_conf["font_size"])
+            self.asset_paths.append(text_conf["font"])
+
+        for image_conf in elements.get("images") or []:
+            if image_conf["from_cover"]:
+                continue
+            self.prepared_overlay(image_conf["path"], image_conf.get("size"))
+            self.asset_paths.append(image_conf["path"])
+
+        for shape_conf in elements.get("shapes") or []:
+            self.shape(shape_conf)
+
+        self.fingerprint = self.current_fingerprint()
+        LOG.info(f"Render plan for '{self.site}' compiled: {len(self.fonts)} fonts, {len(self.overlays)} images, {len(self.shapes)} shapes.")
+
+    def current_fingerprint(self) -> Tuple:
+        return tuple(file_stamp(x) for x in self.asset_paths)
+
+    def is_valid(self) -> bool:
+        """Check if template or any of its files has not changed since compilation"""
+
+        return self.fingerprint == self.current_fingerprint()
+
+    def font(self, path: str, size: int) -> ImageFont.FreeTypeFont:
+        key = (path, size)
+        if key not in self.fonts:
+            self.fonts[key] = ImageFont.truetype(path, size)
+        return self.fonts[key]
+
+    def overlay(self, path: str, size: Optional[List]) -> Optional[Image.Image]:
+        key = (path, tuple(size) if size else None)
+        if key not in self.overlays:
+            image = open_image(path)
+            if image is None:
+                return None
+            if size and image.size != tuple(size):
+                LOG.info(f"Resizing image: {image.size} -> {size}")
+                image = image.resize(tuple(size))
+            self.overlays[key] = image
+        return self.overlays[key]
+
+    def prepared_overlay(self, path: str, size: Optional[List]) -> Optional[PreparedOverlay]:
+        """Overlay with precomputed alpha blending, shared by all stories rendered by the worker"""
+
+        key = (path, tuple(size) if size else None)
+        if key not in self.prepared:
+            image = self.overlay(path, size)
+            if image is None:
+                return None
+            self.prepared[key] = prepare_overlay(image)
+        return self.prepared[key]
+
+    def shape(self, details: Dict) -> Image.Image:
+        key = _shape_key(details)
+        if key not in self.shapes:
+            self.shapes[key] = draw_shape(details)
+        return self.shapes[key]
+
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def template_version(site: str) -> Optional[str]:
+    """Identifier of the current version of the template and all its files"""
+
+    plan = get_render_plan(site)
+    if plan is None:
+        return None
+    return hashlib.sha256(json.dumps(plan.fingerprint, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def get_render_plan(site: str) -> Optional[RenderPlan]:
+    """Compiled template of the site, compiled again if template or its files were changed"""
+
+    with _plans_lock:
+        plan = _plans.get(site)
+        if plan is not None and plan.is_valid():
+            return plan
+
+        LOG.info(f"Compiling render plan for '{site}'...")
+        plan = RenderPlan(site)
+        try:
+            plan.compile()
+        except Exception as e:
+            LOG.exception(f"Render plan for '{site}' couldn't be compiled.")
+            return None
+
+        _plans[site] = plan
+        return plan
@@ -0,0 +1,127 @@
+"""State of the last rendered stories, used to re-render only stories which were changed"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from .file_paths import stories_folder
+from .image_cache import ImageLRUCache
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+MANIFEST_FILE = "manifest.json"
+
+# Max size (MB) of composites (background + shapes + images) kept in the memory of every worker
+COMPOSITES_MAX_MB = int(os.getenv("WPIG_COMPOSITES_MAX_MB", "64"))
+
+# Values which don't affect look of the image
+# (min/max position is computed during creation, number only names the file, post ID identifies the post)
+_NOT_RENDERED = {"number", "post_url", "post_id"}
+_NOT_RENDERED_BACKGROUND = {"min_position_x", "max_position_x"}
+
+COMPOSITES = ImageLRUCache(COMPOSITES_MAX_MB)
+
+
+def _hash(data: Dict) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def file_stamp(path: str) -> Tuple:
+    """Identify version of the file by its modification time and size"""
+
+    try:
+        stat = os.stat(path)
+        return (str(path), stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return (str(path), None, None)
+
+
+def _local_files(elements, texts: bool = True) -> List[str]:
+    """Fonts and images of the template used by the story (covers are identified by their url)"""
+
+    paths = [x.font for x in elements.texts if x.font] if texts else []
+    paths += [x["path"] for x in elements.images or [] if not x.get("from_cover")]
+    paths.append(elements.background.path)
+    return sorted(x for x in set(paths) if os.path.isfile(x))
+
+
+def _rendered_values(elements) -> Dict:
+    data = {k: v for k, v in elements.model_dump().items() if k not in _NOT_RENDERED}
+    data["background"] = {k: v for k, v in data["background"].items() if k not in _NOT_RENDERED_BACKGROUND}
+    return data
+
+
+def render_key(elements) -> str:
+    """Hash of everything that is visible in the story and of the versions of its files"""
+
+    data = _rendered_values(elements)
+    data["files"] = [file_stamp(x) for x in _local_files(elements)]
+    return _hash(data)
+
+
+def base_key(elements) -> str:
+    """Hash of everything except texts (background, shapes and images) and of the versions of their files"""
+
+    data = _rendered_values(elements)
+    data.pop("texts")
+    data["files"] = [file_stamp(x) for x in _local_files(elements, texts=False)]
+    return _hash(data)
+
+
+def manifest_path(site: str, workspace: str = None) -> Path:
+    return stories_folder(site, workspace) / MANIFEST_FILE
+
+
+def load_manifest(site: str, workspace: str = None) -> Dict:
+    """Rendered stories of the site by their number: {number: {render_key, base_key, elements}}"""
+
+    try:
+        with open(manifest_path(site, workspace), "r") as manifest_f:
+            return {int(k): v for k, v in json.load(manifest_f).items()}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(site: str, manifest: Dict, workspace: str = None) -> None:
+    try:
+        with open(manifest_path(site, workspace), "w") as manifest_f:
+            json.dump(manifest, manifest_f)
+    except OSError:
+        LOG.exception(f"Manifest of the stories couldn't be saved -> '{manifest_path(site, workspace)}'")
+
+
+def remove_from_manifest(site: str, number: int, workspace: str = None) -> None:
+    """Drop deleted story from the manifest and shift numbers of the following ones"""
+
+    manifest = {}
+    for story_number, entry in sorted(load_manifest(site, workspace).items()):
+        if story_number == number:
+            continue
+        if story_number > number:
+            story_number -= 1
+            entry["elements"]["number"] = story_number
+        manifest[story_number] = entry
+    save_manifest(site, manifest, workspace)
+
+
+def store_composite(key: str, image: Image.Image) -> None:
+    """Keep image without texts in memory, so it can be reused when only texts are changed"""
+
+    COMPOSITES.put(key, image.copy())
+
+
+def load_composite(key: str) -> Optional[Image.Image]:
+    """Get copy of the image without texts, None if it's not kept by this worker"""
+
+    image = COMPOSITES.get(key)
+    if image is None:
+        return None
+    return image.copy()
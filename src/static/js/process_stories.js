@@ -1,6 +1,35 @@
 $(document).ready(function () {
     $("#download_stories").click(function() {
-        window.location.href = `/download_stories?site=${site}`;
+        const button = this;
+        button.disabled = true;
+
+        // Previews are rendered in the full resolution in the background, download starts when they are ready
+        fetch(`/jobs/render_full_resolution`, {
+            method: "POST",
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({site: site}),
+        })
+        .then(response => {
+            if (!response.ok){
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(job => waitForJob(job.status_url))
+        .then(renderStatus => {
+            button.disabled = false;
+            if (renderStatus.success) {
+                window.location.href = `/download_stories?site=${site}`;
+            } else {
+                console.log(`Rendering stories failed ${renderStatus.error}`)
+            }
+        })
+        .catch(error => {
+            button.disabled = false;
+            console.log(`Rendering stories failed ${error}`)
+        });
     });
 
     $("#sendMail").click(function() {
@@ -24,7 +53,8 @@ $(document).ready(function () {
                 links.push($(this).data('url'));
             });
 
-            fetch(`/send_by_email`, {
+            // Email is sent in the background, wait until the job is finished
+            fetch(`/jobs/send_by_email`, {
                 method: "POST",
                 headers: {
                     'Content-Type': 'application/json',
@@ -41,6 +71,7 @@ $(document).ready(function () {
                 }
                 return response.json();
             })
+            .then(job => waitForJob(job.status_url))
             .then(mailStatus => {
                 // Change loading circle to check or fail
                 if (mailStatus.success) {
@@ -86,6 +117,27 @@ $(document).ready(function () {
     }
 });
 
+// Poll status of the background job until it's finished
+function waitForJob(statusUrl){
+    return fetch(statusUrl, {method: 'GET'})
+        .then(response => {
+            if (!response.ok){
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(job => {
+            if (job.status === "done") {
+                return {success: true};
+            }
+            if (job.status === "failed") {
+                return {success: false, error: job.error};
+            }
+            return new Promise(resolve => setTimeout(resolve, 1000))
+                .then(() => waitForJob(statusUrl));
+        });
+}
+
 function deleteStory(story_number){
     fetch(`/delete_story/${site}/${story_number}`, {method: 'DELETE'})
         .then(response => {
@@ -116,6 +116,8 @@ $(document).ready(function () {
                 body: JSON.stringify({
                     site: site,
                     posts_elements: adjusted_posts_elements,
+                    incremental: true,
+                    preview: true,
                 }),
             });
         })
@@ -44,82 +44,47 @@ $(document).ready(function(){
          console.log("Number:", postsNum);
          console.log("Date:", postsFrom);
          
-         fetch(`/get_posts_data?site=${site}&links=${links}&number=${postsNum}&from_date=${postsFrom}`, {
-             method: "GET"
-         })
-         .then(response => {
-            if (!response.ok){
-                throw new Error(`HTTP error! Status: ${response.status}`);
-            }
-            return response.json();
-        })
-         .then(postsData => {
-            if (postsData.success){
-                data_posts = JSON.stringify(postsData.data);
-            } else{
-                console.error(`Server error: ${postsData.error}`);
-            }
-             return fetch(`/get_stories_template?site=${site}`, {
-                 method: "GET"
-             });
-         })
-         .then(response => {
-            if (!response.ok){
-                throw new Error(`HTTP error! Status: ${response.status}`);
-            }
-            return response.json();
-        }) 
-        .then(templateData => {
-            if (templateData.success){
-                template = JSON.stringify(templateData.data);
-            } else {
-                console.error(`Server error: ${templateData.error}`);
-            }
-             return fetch(`/get_posts_elements?posts=${data_posts}&template=${template}`, {
-                 method: "GET"
-             });
-         })
-         .then(response => {
-            if (!response.ok){
-                throw new Error(`HTTP error! Status: ${response.status}`);
-            }
-            return response.json();
+         // Whole generation runs on the server, progress is streamed back
+         const params = new URLSearchParams({
+             site: site,
+             links: links.join(","),
+             number: postsNum,
+             from_date: postsFrom,
+             preview: 1,
+         });
+         const progress = document.getElementById('loading_modal_count');
+         progress.textContent = "";
 
-         })
-         .then(postsElementsList => {
-            if (postsElementsList.success) {
-                posts_elements = postsElementsList.data;
-            } else {
-                console.error(`Server error: ${postsElementsList.error}`);
-            }
-             
-             return fetch(`/create_images`, {
-                 method: "POST",
-                 headers: {
-                     'Content-Type': 'application/json',
-                 },
-                 body: JSON.stringify({
-                     site: site,
-                     posts_elements: posts_elements,
-                 }),
-             });
-         })
-         .then(response => {
-            if (!response.ok){
-                // Hide loading circle and display info about error to user
-                document.getElementById('loading_modal_progress').style.display = "none";
-                document.getElementById('loading_modal_failed').style.display = "block";
-                document.getElementById('loadingModalHead').style.display = "block";
-                throw new Error(`HTTP error! Status: ${response.status}`);
-            } else {
-                return response.json()
-            }
-         })
-         .then(result => {
-             window.location.href = `/show_images?site=${site}`;
-         })
-         .catch(error => {
-            console.error('Error:', error.message);
+         const source = new EventSource(`/generate_stories?${params.toString()}`);
+
+         source.addEventListener("posts", function(e) {
+             const data = JSON.parse(e.data);
+             progress.textContent = `0/${data.count}`;
+         });
+
+         source.addEventListener("story", function(e) {
+             const data = JSON.parse(e.data);
+             console.log("Story created:", data.image_url);
+             progress.textContent = `${data.created}/${data.total}`;
+         });
+
+         source.addEventListener("done", function(e) {
+             const data = JSON.parse(e.data);
+             source.close();
+             window.location.href = data.redirect_url;
+         });
+
+         source.addEventListener("error", function(e) {
+             source.close();
+             if (e.data) {
+                 console.error(`Server error: ${JSON.parse(e.data).error}`);
+             } else {
+                 console.error("Connection to the server failed.");
+             }
+             // Hide loading circle and display info about error to user
+             document.getElementById('loading_modal_progress').style.display = "none";
+             document.getElementById('loading_modal_failed').style.display = "block";
+             document.getElementById('loadingModalHead').style.display = "block";
          });
          
         // Display loading modal if no alert was raised
@@ -0,0 +1,92 @@
+"""Layout of the texts by the real width of the glyphs in pixels"""
+
+import logging
+import sys
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from PIL import ImageFont
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Advance widths of already measured characters by (font path, size)
+_glyph_widths: Dict[Tuple[str, int], Dict[str, float]] = {}
+_glyph_lock = threading.Lock()
+
+
+def glyph_widths(font: ImageFont.FreeTypeFont) -> Dict[str, float]:
+    """Cache of the character widths of the font"""
+
+    key = (font.path, font.size)
+    widths = _glyph_widths.get(key)
+    if widths is None:
+        with _glyph_lock:
+            widths = _glyph_widths.setdefault(key, {})
+    return widths
+
+
+def text_width(text: str, font: ImageFont.FreeTypeFont) -> float:
+    """Width of the text as the sum of its glyphs advances (kerning is ignored, so it's never narrower than drawn)"""
+
+    widths = glyph_widths(font)
+    total = 0
+    for char in text:
+        width = widths.get(char)
+        if width is None:
+            width = widths[char] = font.getlength(char)
+        total += width
+    return total
+
+
+def wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: float) -> List[str]:
+    """Split text into lines not wider than max_width, words are not split.
+    Every word is measured once, so the layout takes linear time.
+    Newlines in the text are kept"""
+
+    space = text_width(" ", font)
+    lines = []
+    for paragraph in text.rstrip().split("\n"):
+        line = []
+        line_width = 0
+        for word in paragraph.split():
+            width = text_width(word, font)
+            # Word longer than max width gets its own line
+            if line and line_width + space + width > max_width:
+                lines.append(" ".join(line))
+                line, line_width = [], 0
+            line_width += width + (space if line else 0)
+            line.append(word)
+        lines.append(" ".join(line))
+    return lines
+
+
+def fits(lines: List[str], font: ImageFont.FreeTypeFont, max_width: float, max_height: float, line_height: float) -> bool:
+    if len(lines) * font.size * line_height > max_height:
+        return False
+    return all(text_width(x, font) <= max_width for x in lines)
+
+
+def fit_text(text: str, get_font: Callable[[int], ImageFont.FreeTypeFont], max_width: float, max_height: float,
+             line_height: float, min_size: int, max_size: int) -> Tuple[ImageFont.FreeTypeFont, List[str]]:
+    """Binary search for the largest font size at which the wrapped text fits into the box.
+    Returns font and lines, in the min size if the text doesn't fit at all"""
+
+    best = None
+    low, high = min_size, max_size
+    while low <= high:
+        size = (low + high) // 2
+        font = get_font(size)
+        lines = wrap_text(text, font, max_width)
+        if fits(lines, font, max_width, max_height, line_height):
+            best = (font, lines)
+            low = size + 1
+        else:
+            high = size - 1
+
+    if best is None:
+        LOG.warning(f"Text '{text}' doesn't fit into {max_width}x{max_height} even with font size {min_size}.")
+        font = get_font(min_size)
+        best = (font, wrap_text(text, font, max_width))
+    return best
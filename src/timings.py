@@ -0,0 +1,186 @@
+"""Timing of the pipeline stages - Server-Timing headers, timings of the stories and Prometheus metrics"""
+
+import contextvars
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Upper bounds of the histogram buckets (seconds)
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Timings collected by the current request or story
+_current = contextvars.ContextVar("timings", default=None)
+
+
+class Histogram:
+    """Thread safe Prometheus histogram with one label"""
+
+    def __init__(self, name: str, description: str, label: str, buckets: List[float] = BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        # label value -> [counts of buckets, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, seconds: float) -> None:
+        with self._lock:
+            if label_value not in self._values:
+                self._values[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            values = self._values[label_value]
+            # Buckets are cumulative
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    values[0][i] += 1
+            values[1] += seconds
+            values[2] += 1
+
+    def exposition(self) -> str:
+        """Histogram in the Prometheus text format"""
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, (counts, total, count) in sorted(self._values.items()):
+                label = f'{self.label}="{label_value}"'
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{label}}} {total}")
+                lines.append(f"{self.name}_count{{{label}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter:
+    """Thread safe Prometheus counter with one label"""
+
+    def __init__(self, name: str, description: str, label: str):
+        self.name = name
+        self.description = description
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: int = 1) -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value: str) -> int:
+        with self._lock:
+            return self._values.get(label_value, 0)
+
+    def exposition(self) -> str:
+        """Counter in the Prometheus text format"""
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_value, count in sorted(self._values.items()):
+                lines.append(f'{self.name}{{{self.label}="{label_value}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+STAGE_DURATION = Histogram("wpig_stage_duration_seconds", "Duration of the stories pipeline stages.", "stage")
+REQUEST_DURATION = Histogram("wpig_request_duration_seconds", "Duration of the requests by endpoint.", "endpoint")
+RENDER_CACHE_REQUESTS = Counter("wpig_render_cache_requests_total", "Lookups of the rendered stories cache by result.", "result")
+
+
+class Timings:
+    """Durations of the stages measured within the request or story"""
+
+    def __init__(self):
+        self.events = []
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.events.append((stage, seconds))
+
+    def totals(self) -> Dict[str, float]:
+        """Total duration of every stage in milliseconds"""
+
+        totals = {}
+        for stage, seconds in self.events:
+            totals[stage] = totals.get(stage, 0) + seconds * 1000
+        return {k: round(v, 1) for k, v in totals.items()}
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """Value of the Server-Timing header"""
+
+        metrics = [f"{stage};dur={duration}" for stage, duration in self.totals().items()]
+        metrics.append(f"total;dur={round(self.elapsed() * 1000, 1)}")
+        return ", ".join(metrics)
+
+
+def record(stage: str, seconds: float) -> None:
+    """Add stage duration to the metrics and to the timings collected at the moment"""
+
+    STAGE_DURATION.observe(stage, seconds)
+    timings = _current.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+def replay(events: List[Tuple[str, float]]) -> None:
+    """Record stages measured in other process (metrics of the render processes are not exported)"""
+
+    for stage, seconds in events:
+        record(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Measure duration of the block as the stage"""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def collect() -> Iterator[Timings]:
+    """Collect timings of the block separately (e.g. single story),
+    they are also added to the timings collected outside of the block"""
+
+    outer = _current.get()
+    timings = Timings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+        if outer is not None:
+            outer.events.extend(timings.events)
+
+
+def start_request() -> None:
+    """Start collecting timings of the request (every request has its own thread or greenlet)"""
+
+    _current.set(Timings())
+
+
+def current_timings() -> Optional[Timings]:
+    return _current.get()
+
+
+def finish_request(endpoint: str) -> None:
+    timings = _current.get()
+    if timings is not None:
+        REQUEST_DURATION.observe(endpoint, timings.elapsed())
+    _current.set(None)
+
+
+def metrics_exposition() -> str:
+    """All metrics of the worker in the Prometheus text format"""
+
+    return STAGE_DURATION.exposition() + REQUEST_DURATION.exposition() + RENDER_CACHE_REQUESTS.exposition()
@@ -0,0 +1,75 @@
+"""Isolated output folders of the sessions and their cleanup"""
+
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import uuid
+
+from .file_paths import workspaces_folder
+from .metadata_store import remove_workspace_metadata
+
+LOG = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+LOG.addHandler(handler)
+
+# Workspace not used for this time (seconds) is removed
+WORKSPACE_TTL = int(os.getenv("WPIG_WORKSPACE_TTL", str(6 * 3600)))
+# How often expired workspaces are looked for (seconds)
+CLEANUP_INTERVAL = 600
+
+_WORKSPACE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+_last_cleanup = 0
+_cleanup_lock = threading.Lock()
+
+
+def new_workspace() -> str:
+    """Create ID of the new workspace"""
+
+    return uuid.uuid4().hex
+
+
+def is_valid_workspace(workspace: str) -> bool:
+    return bool(workspace) and bool(_WORKSPACE_ID.match(workspace))
+
+
+def touch_workspace(workspace: str) -> None:
+    """Mark workspace as used, so it's not removed"""
+
+    path = workspaces_folder() / workspace
+    try:
+        os.makedirs(path, exist_ok=True)
+        os.utime(path)
+    except OSError:
+        LOG.exception(f"Workspace '{path}' couldn't be updated.")
+
+
+def remove_expired_workspaces(force: bool = False) -> None:
+    """Remove workspaces which were not used longer than TTL (checked at most once per interval)"""
+
+    global _last_cleanup
+
+    with _cleanup_lock:
+        if not force and time.time() - _last_cleanup < CLEANUP_INTERVAL:
+            return None
+        _last_cleanup = time.time()
+
+    root = workspaces_folder()
+    if not root.exists():
+        return None
+
+    for path in root.iterdir():
+        if not is_valid_workspace(path.name):
+            continue
+        try:
+            expired = time.time() - path.stat().st_mtime > WORKSPACE_TTL
+        except OSError:
+            continue
+        if expired:
+            LOG.info(f"Removing expired workspace '{path}'")
+            shutil.rmtree(path, ignore_errors=True)
+            remove_workspace_metadata(path.name)